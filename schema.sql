@@ -0,0 +1,51 @@
+-- The columns and indexes the optional features of the tester need in the site's database.
+-- The tester does not change the schema by itself; apply this once, outside a transaction:
+--   psql -f schema.sql <database>
+-- Every statement can be rerun safely.
+
+-- behaviour.heartbeat_timeout
+ALTER TABLE checker_statuses
+ADD COLUMN IF NOT EXISTS tester_name text,
+ADD COLUMN IF NOT EXISTS compilers text[],
+ADD COLUMN IF NOT EXISTS runners text[],
+ADD COLUMN IF NOT EXISTS attempt_ids integer[] NOT NULL DEFAULT '{}',
+ADD COLUMN IF NOT EXISTS live_attempt_ids integer[] NOT NULL DEFAULT '{}';
+ALTER TABLE attempts
+ADD COLUMN IF NOT EXISTS retries integer NOT NULL DEFAULT 0;
+
+-- behaviour.notify_channel, unless the site notifies it itself (change the channel here if needed)
+CREATE OR REPLACE FUNCTION lerna_tester_notify() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('lerna_attempts', NEW.id::text);
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+DROP TRIGGER IF EXISTS lerna_tester_notify ON attempts;
+CREATE TRIGGER lerna_tester_notify
+AFTER INSERT OR UPDATE OF result ON attempts
+FOR EACH ROW
+WHEN (NEW.result IS NULL OR NEW.result = '')
+EXECUTE PROCEDURE lerna_tester_notify();
+
+-- calibration.reference
+ALTER TABLE checker_statuses
+ADD COLUMN IF NOT EXISTS time_multiplier real;
+
+-- behaviour.incremental_rejudge
+ALTER TABLE test_infos
+ADD COLUMN IF NOT EXISTS fingerprint text;
+
+-- behaviour.memoize_results
+ALTER TABLE attempts
+ADD COLUMN IF NOT EXISTS fingerprint text;
+CREATE INDEX CONCURRENTLY IF NOT EXISTS lerna_attempts_fingerprint
+ON attempts (fingerprint)
+WHERE fingerprint IS NOT NULL;
+
+-- The queue queries (the same as behaviour.install_queue_indexes creates).
+CREATE INDEX CONCURRENTLY IF NOT EXISTS lerna_attempts_untested
+ON attempts (time)
+WHERE result IS NULL OR result = '';
+CREATE INDEX CONCURRENTLY IF NOT EXISTS lerna_attempts_in_progress
+ON attempts (user_id)
+WHERE result IN ('Queued', 'Compiling...') OR result LIKE 'Testing...%';
@@ -4,31 +4,79 @@
 Polls the database for attempts and tests them at the specified path.
 
 Usage:
-  ./lerna-tester -c <config> [-f] [-l <log-dir>] [-n <name>] [--] <cwd>
+  ./lerna-tester -c <config> [-f] [-l <log-dir>] [-n <name>] [-w <count>] [--] <cwd>
 
 Options:
-  -c, --config <file>   Path to a YAML configuration file.
-  -f, --force           Do not prompt if the working directory is not empty.
-  -l, --log-dir <path>  Directory to put the logs in [default: ./].
-  -n, --name <name>     Specify a name to differentiate this tester from others.
+  -c, --config <file>    Path to a YAML configuration file.
+  -f, --force            Do not prompt if the working directory is not empty.
+  -l, --log-dir <path>   Directory to put the logs in [default: ./].
+  -n, --name <name>      Specify a name to differentiate this tester from others.
+  -w, --workers <count>  Number of attempts to test simultaneously [default: 1].
 """
 
+import ctypes
 import docopt
 import logging.config
 import os
 import pathlib
+import select
 import signal
 import sys
+import threading
 
+import calibration
 import config
+import metrics
 import tester
 
 
 terminating = False
+interrupting = False
+workers = [ ] # Threads of `run_workers`, if it is running.
+# Becomes readable when the testers are asked to stop; drained before restarting them.
+wakeup_r, wakeup_w = os.pipe()
+os.set_blocking(wakeup_r, False)
+os.set_blocking(wakeup_w, False)
+
+
+def wake_up():
+    try:
+        os.write(wakeup_w, b"\0")
+    except BlockingIOError:
+        pass # Already readable.
+
+
+def reset_wakeup():
+    try:
+        while os.read(wakeup_r, 4096):
+            pass
+    except BlockingIOError:
+        pass
 
 
 def gracefully_restart(*args):
     tester.needs_restarting = True
+    wake_up()
+
+
+def interrupt_workers():
+    """
+    Raises SystemExit in the worker threads, as the signal does in a single tester, so that
+    they mark the attempts being tested and release the claimed ones. Waits for them to finish.
+    A repeated signal meanwhile exits at once.
+    """
+
+    global interrupting
+    if interrupting:
+        sys.exit()
+    interrupting = True
+    for worker in workers:
+        if worker.is_alive():
+            ctypes.pythonapi.PyThreadState_SetAsyncExc(
+                ctypes.c_ulong(worker.ident), ctypes.py_object(SystemExit))
+    wake_up() # Those idle are waiting for it.
+    for worker in workers:
+        worker.join()
 
 
 def gracefully_shutdown(*args):
@@ -36,12 +84,28 @@ def gracefully_shutdown(*args):
     if not terminating:
         print("Shutting down", flush=True)
         terminating = tester.needs_restarting = True
+        wake_up()
     else:
         print("Terminating", flush=True)
+        interrupt_workers()
         sys.exit()
 
 
-def sleep(duration):
+def terminate(*args):
+    interrupt_workers()
+    sys.exit("SIGQUIT received")
+
+
+def sleep(duration, *fds):
+    """
+    Waits for the given number of seconds, a signal or, if specified, data on the descriptors.
+    """
+
+    if fds or threading.current_thread() is not threading.main_thread():
+        # The signal handlers are run by the main thread only; the wakeup fd notifies the others.
+        select.select([wakeup_r, *fds], [], [], duration)
+        return
+
     signal.pthread_sigmask(signal.SIG_BLOCK, [signal.SIGHUP, signal.SIGINT, signal.SIGTERM])
     try:
         acquired = signal.sigtimedwait([signal.SIGHUP, signal.SIGINT, signal.SIGTERM], duration)
@@ -54,8 +118,51 @@ def sleep(duration):
         signal.pthread_sigmask(signal.SIG_UNBLOCK, [signal.SIGHUP, signal.SIGINT, signal.SIGTERM])
 
 
+def run_workers(cnf, cwd, name, count, watcher):
+    """
+    Runs `count` testers in separate threads, each in its own subdirectory of `cwd`.
+    """
+
+    failed = [ ]
+
+    def work(worker_cwd, worker_name):
+        try:
+            tester.run(cnf, worker_cwd, worker_name, sleep, watcher)
+        except SystemExit:
+            pass # Interrupted by the main thread.
+        except:
+            failed.append(worker_name)
+            tester.needs_restarting = True
+            wake_up()
+            raise
+
+    for i in range(1, count + 1):
+        worker_cwd = cwd / str(i)
+        worker_cwd.mkdir(exist_ok=True)
+        worker_cwd.chmod(0o777)
+        # Daemonic, so that a signal repeated once more does not wait for the running attempts.
+        workers.append(threading.Thread(
+            target=work, args=(worker_cwd, "%s#%d" % (name, i)), daemon=True))
+
+    try:
+        for worker in workers:
+            worker.start()
+        while not tester.needs_restarting:
+            select.select([wakeup_r], [], [])
+        for worker in workers:
+            worker.join()
+    finally:
+        workers.clear()
+
+    if failed:
+        sys.exit("Worker %s failed" % ", ".join(failed))
+
+
 def main():
     args = docopt.docopt(__doc__)
+    workers = int(args["--workers"])
+    if workers < 1:
+        sys.exit("The number of workers must be positive")
     log_dir = pathlib.Path(args["--log-dir"])
     cwd = pathlib.Path(args["<cwd>"])
 
@@ -74,20 +181,34 @@ def main():
     while not terminating:
         os.chdir(initial_dir)
         tester.needs_restarting = False
+        reset_wakeup()
         cnf = config.read(args["--config"])
 
         log_dir.mkdir(parents=True, exist_ok=True)
         os.chdir(str(log_dir)) # Log file paths are either absolute or relative to log_dir.
         logging.config.dictConfig(cnf["logging"])
+        exporter = metrics.Exporter(cnf.get("metrics"))
+        watcher = config.ExecutablesWatcher(cnf)
+        calibrator = calibration.Calibrator(cnf)
 
         os.chdir(str(cwd))
-        tester.run(cnf, cwd, args["--name"] or "", sleep)
+        try:
+            if workers == 1:
+                tester.run(cnf, cwd, args["--name"] or "", sleep, watcher)
+            else:
+                run_workers(cnf, cwd, args["--name"] or "", workers, watcher)
+        finally:
+            calibrator.close()
+            watcher.close()
+            exporter.stop()
+    tester.close_connections()
 
 
 if __name__ == "__main__":
-    signal.signal(signal.SIGQUIT, lambda signum, frame: sys.exit("SIGQUIT received"))
+    signal.signal(signal.SIGQUIT, terminate)
     signal.signal(signal.SIGTERM, gracefully_shutdown)
     signal.signal(signal.SIGINT,  gracefully_shutdown)
     signal.signal(signal.SIGHUP,  gracefully_restart)
+    signal.set_wakeup_fd(wakeup_w)
 
     main()
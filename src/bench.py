@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+
+"""
+Measures the throughput of the judging pipeline on synthetic problems.
+
+Generates a problem with many tiny tests and a problem with a few huge ones, stub scripts
+compatible with the compilers/runners/checkers layout, and runs attempts through
+`tester.process_attempt` against an in-memory stand-in for the database.
+
+Usage:
+  ./src/bench.py [-a <count>] [-t <count>] [-H <count>] [-s <MB>] [-c] [-b <kind>] [-k] [-w <dir>]
+
+Options:
+  -a, --attempts <count>     Attempts to test per problem [default: 20].
+  -t, --tiny-tests <count>   Number of tests of the tiny problem [default: 100].
+  -H, --huge-tests <count>   Number of tests of the huge problem [default: 3].
+  -s, --huge-size <MB>       Size of each huge test [default: 64].
+  -c, --compilation-cache    Enable the compilation cache.
+  -b, --sandbox <kind>       Sandbox kind: clean, rotate or tmpfs [default: clean].
+  -k, --keep                 Do not remove the working directory afterwards.
+  -w, --work-dir <dir>       Where to put the generated files [default: a temporary directory].
+"""
+
+import collections
+import contextlib
+import docopt
+import functools
+import io
+import pathlib
+import random
+import shutil
+import tempfile
+import time
+
+import cache
+import models
+import sandbox
+import testset
+import tester
+
+
+COMPILER = """\
+#!/bin/sh
+# The "binary" is the source itself.
+exec cat
+"""
+
+RUNNER = """\
+#!/bin/sh
+# Usage: runner <stdin> <stdout> <stderr> <time limit> <memory limit>, the binary is on stdin.
+cat > solution
+chmod +x solution
+if ./solution < "$1" > "$2" 2> "$3"; then
+    echo "Status: OK"
+else
+    echo "Status: RT"
+fi
+echo "CPUTime: 1"
+echo "RealTime: 1"
+echo "VMSize: 1048576"
+"""
+
+CHECKER = """\
+#!/bin/sh
+# Usage: checker <input> <output> <answer>
+if cmp -s "$2" "$3"; then
+    echo "ok" >&2
+    exit 0
+fi
+echo "wrong answer" >&2
+exit 1
+"""
+
+SOLUTION = """\
+#!/bin/sh
+exec cat
+"""
+
+
+class MemoryConnection:
+    """
+    A stand-in for `database.Connection` that keeps everything in memory.
+    """
+
+    def __init__(self, attempts):
+        self.queue = collections.deque(attempts)
+        self.results = { }
+        self.test_infos = [ ]
+        self._pending_test_infos = [ ]
+
+    def close(self):
+        pass
+
+    def create_tester_status(self):
+        return 1
+
+    def update_tester_status(self, status):
+        pass
+
+    def delete_tester_status(self, status):
+        pass
+
+    def acquire_untested_attempt(self, tester_name, result, available_compilers, available_runners):
+        return self.queue.popleft() if self.queue else None
+
+    def acquire_untested_attempts(
+        self, tester_name, result, available_compilers, available_runners, limit,
+    ):
+        return [self.queue.popleft() for _ in range(min(limit, len(self.queue)))]
+
+    def release_attempts(self, attempt_ids, tester_name, result):
+        pass
+
+    def update_attempt_result(self, attempt_id, result, *args):
+        self.results[attempt_id] = result
+
+    update_attempt_result_and_error_message = update_attempt_result
+    update_attempt_result_and_stats = update_attempt_result
+    update_attempt_result_and_stats_with_score = update_attempt_result
+    update_attempt_result_and_stats_with_comment = update_attempt_result
+
+    def report_progress(self, attempt_id, result, used_time, used_memory):
+        self.update_attempt_result_and_stats(attempt_id, result, used_time, used_memory)
+
+    def add_test_info(self, *args):
+        self._pending_test_infos.append(args)
+
+    def finish_attempt(self, update, *args):
+        self.test_infos += self._pending_test_infos
+        self._pending_test_infos.clear()
+        update(*args)
+
+
+class StageTimer:
+    def __init__(self):
+        self.samples = collections.defaultdict(list)
+
+    def wrap(self, stage, func):
+        @functools.wraps(func)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.samples[stage].append(time.perf_counter() - start)
+        return timed
+
+    def instrument_pipeline(self):
+        """
+        Replaces the pipeline's stages with their timed versions.
+        """
+
+        tester.compile_source = self.wrap("compile", tester.compile_source)
+        testset.provide = self.wrap("test copy", testset.provide)
+        tester.execute_program = self.wrap("execute", tester.execute_program)
+        tester.check_output = self.wrap("check", tester.check_output)
+
+    def instrument_database(self, db):
+        for name in (
+            "update_attempt_result", "report_progress", "add_test_info", "finish_attempt",
+        ):
+            setattr(db, name, self.wrap("database", getattr(db, name)))
+
+
+def percentile(sorted_samples, p):
+    return sorted_samples[min(int(len(sorted_samples) * p), len(sorted_samples) - 1)]
+
+
+def write_executable(path, content):
+    path.write_text(content)
+    path.chmod(0o755)
+
+
+def generate(work_dir, tiny_tests, huge_tests, huge_size):
+    rnd = random.Random(0)
+    for name in ("compilers", "runners", "checkers", "problems/tiny", "problems/huge", "sandbox"):
+        (work_dir / name).mkdir(parents=True)
+    write_executable(work_dir / "compilers" / "sh", COMPILER)
+    write_executable(work_dir / "runners" / "sh", RUNNER)
+    write_executable(work_dir / "checkers" / "cmp", CHECKER)
+
+    for i in range(1, tiny_tests + 1):
+        data = "%d %d\n" % (rnd.randrange(10 ** 9), rnd.randrange(10 ** 9))
+        (work_dir / "problems" / "tiny" / ("%03d" % i)).write_text(data)
+        (work_dir / "problems" / "tiny" / ("%03d.a" % i)).write_text(data)
+
+    line = b"".join(b"%d " % rnd.randrange(10 ** 9) for _ in range(1000)) + b"\n"
+    for i in range(1, huge_tests + 1):
+        for path in (work_dir / "problems" / "huge" / ("%03d" % i),
+                     work_dir / "problems" / "huge" / ("%03d.a" % i)):
+            with path.open("wb") as f:
+                for _ in range(huge_size * 2 ** 20 // len(line)):
+                    f.write(line)
+
+
+def make_config(work_dir, compilation_cache, sandbox_kind):
+    return {
+        "dirs": {
+            "problems": work_dir / "problems",
+            "compilers": work_dir / "compilers",
+            "runners": work_dir / "runners",
+            "checkers": work_dir / "checkers",
+            "cache": work_dir / "cache" if compilation_cache else None,
+        },
+        "exec": {
+            "compilers": {"sh": str(work_dir / "compilers" / "sh")},
+            "runners": {"sh": str(work_dir / "runners" / "sh")},
+            "checkers": {"cmp": str(work_dir / "checkers" / "cmp")},
+        },
+        "behaviour": {
+            "interval": 1,
+            "time_multiplier": 1,
+            "checker_comment_max_len": 255,
+            "compilation_cache_size": 2 ** 30,
+            "sandbox": sandbox_kind,
+        },
+        "files": {
+            "stdin": "input.txt",
+            "stdout": "output.txt",
+            "stderr": "error.txt",
+            "compiler_log": "compiler.log",
+            "ejudge_log": "ejudge.log",
+        },
+    }
+
+
+def make_attempts(problem_path, count):
+    problem = models.Problem(1, problem_path, problem_path, 10000, 256, "cmp", "%03d", "%03d.a")
+    pic = models.ProblemInContest(problem, models.Contest(1, False), "A")
+    user = models.User("bench", "Benchmark")
+    compiler = models.Compiler("Shell", "sh", "sh")
+    # Comments make the sources distinct, so that the compilation cache is hit on rejudges only.
+    return [
+        models.Attempt(i, pic, user, SOLUTION + "# %d\n" % i, compiler)
+        for i in range(1, count + 1)
+    ]
+
+
+def bench(cnf, work_dir, timer, problem_path, count):
+    db = MemoryConnection(make_attempts(problem_path, count))
+    timer.samples.clear()
+    timer.instrument_database(db)
+    compilation_cache = cache.CompilationCache.from_config(cnf)
+    box = sandbox.from_config(cnf, work_dir / "sandbox")
+    box.reset = timer.wrap("sandbox reset", box.reset)
+
+    start_time = time.perf_counter()
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            while db.queue:
+                attempt = db.queue.popleft()
+                tester.process_attempt(db, cnf, box, attempt, { }, compilation_cache)
+    finally:
+        box.close()
+    elapsed = time.perf_counter() - start_time
+
+    accepted = sum(result == "Accepted" for result in db.results.values())
+    print("%s: %d attempts (%d accepted) in %.2f sec, %.2f attempts/sec" % (
+        problem_path, count, accepted, elapsed, count / elapsed))
+    print("  {:<18}{:>8}{:>10}{:>10}{:>10}{:>10}".format(
+        "stage", "calls", "p50, ms", "p90, ms", "p99, ms", "total, s"))
+    for stage, samples in timer.samples.items():
+        samples.sort()
+        print("  {:<18}{:>8}{:>10.2f}{:>10.2f}{:>10.2f}{:>10.2f}".format(
+            stage,
+            len(samples),
+            percentile(samples, .5) * 1000,
+            percentile(samples, .9) * 1000,
+            percentile(samples, .99) * 1000,
+            sum(samples),
+        ))
+    print(flush=True)
+
+
+def main():
+    args = docopt.docopt(__doc__)
+    if args["--work-dir"] == "a temporary directory":
+        work_dir = pathlib.Path(tempfile.mkdtemp(prefix="lerna-bench-"))
+    else:
+        work_dir = pathlib.Path(args["--work-dir"])
+        work_dir.mkdir(parents=True)
+    work_dir = work_dir.resolve()
+
+    try:
+        generate(
+            work_dir,
+            int(args["--tiny-tests"]),
+            int(args["--huge-tests"]),
+            int(args["--huge-size"]),
+        )
+        cnf = make_config(work_dir, args["--compilation-cache"], args["--sandbox"])
+        timer = StageTimer()
+        timer.instrument_pipeline()
+        for problem_path in ("tiny", "huge"):
+            bench(cnf, work_dir, timer, problem_path, int(args["--attempts"]))
+    finally:
+        if not args["--keep"]:
+            shutil.rmtree(str(work_dir))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+import hashlib
+import os
+import struct
+import tempfile
+
+
+class CompilationCache:
+    """
+    Content-addressed on-disk cache of compilation results (binaries as well as errors).
+    Can be shared by any number of testers: entries are replaced atomically, and the least recently
+    used ones are evicted as soon as the total size exceeds the limit.
+    """
+
+    _HEADER = struct.Struct("!?Q") # Succeeded, length of the compiler's stderr.
+
+    def __init__(self, path, max_size):
+        self._path = path
+        self._max_size = max_size
+        path.mkdir(parents=True, exist_ok=True)
+
+    @classmethod
+    def from_config(cls, cnf):
+        if cnf["dirs"].get("cache") is None:
+            return None
+        return cls(
+            cnf["dirs"]["cache"] / "compiled",
+            cnf["behaviour"].get("compilation_cache_size", 2 ** 30),
+        )
+
+    @staticmethod
+    def key(compiler_codename, compiler_path, source: bytes) -> str:
+        # The compiler is usually a script, so its real version cannot be determined. Touch the
+        # script after upgrading the underlying compiler to invalidate the entries.
+        stat = os.stat(compiler_path)
+        h = hashlib.sha256("{}\0{}\0{}\0{}\0".format(
+            compiler_codename, compiler_path, stat.st_mtime_ns, stat.st_size,
+        ).encode())
+        h.update(source)
+        return h.hexdigest()
+
+    def get(self, key) -> (bytes, bytes):
+        """
+        Returns the (binary, errors) pair stored under the given key, or None if there is none.
+        The binary is None if the compilation failed.
+        """
+
+        entry = self._path / key
+        try:
+            with entry.open("rb") as f:
+                content = f.read()
+            os.utime(str(entry)) # Mark as recently used.
+        except FileNotFoundError:
+            return None
+
+        succeeded, errors_len = self._HEADER.unpack_from(content)
+        errors = content[self._HEADER.size:self._HEADER.size + errors_len]
+        data = content[self._HEADER.size + errors_len:] if succeeded else None
+        return data, errors
+
+    def put(self, key, data, errors):
+        fd, tmp_name = tempfile.mkstemp(dir=str(self._path), prefix=".")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(self._HEADER.pack(data is not None, len(errors)))
+                f.write(errors)
+                if data is not None:
+                    f.write(data)
+            os.replace(tmp_name, str(self._path / key))
+        except:
+            os.unlink(tmp_name)
+            raise
+        self._evict()
+
+    def _evict(self):
+        entries = [ ]
+        total_size = 0
+        for entry in os.scandir(str(self._path)):
+            if entry.name.startswith("."):
+                continue # Being written by someone.
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue # Evicted by someone else.
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total_size += stat.st_size
+
+        if total_size > self._max_size:
+            entries.sort()
+            for _, size, path in entries:
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+                total_size -= size
+                if total_size <= self._max_size:
+                    break
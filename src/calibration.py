@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+
+"""
+Runs a CPU and memory benchmark and prints its CPU time in seconds. The time on the machine
+the time limits are set for is the `calibration.reference` of the config.
+
+Usage:
+  ./src/calibration.py
+"""
+
+import contextlib
+import docopt
+import os.path
+import subprocess
+import sys
+import threading
+import time
+
+
+def workload() -> float:
+    start_time = time.process_time()
+    x = 1
+    # Integer arithmetic.
+    for _ in range(1000000):
+        x = (x * 1103515245 + 12345) & 0x7FFFFFFF
+    # Random access to a buffer much larger than the caches.
+    buf = bytearray(64 << 20)
+    for _ in range(1000000):
+        x = (x * 1103515245 + 12345) & 0x7FFFFFFF
+        i = x % len(buf)
+        buf[i] = (buf[i] + 1) & 0xFF
+    return time.process_time() - start_time
+
+
+def benchmark() -> float:
+    """
+    Runs the workload in a separate process, so that the other threads of the tester do not
+    affect the result, and returns its CPU time in seconds.
+    """
+
+    return float(subprocess.run(
+        [sys.executable, os.path.abspath(__file__)],
+        stdout=subprocess.PIPE, check=True, timeout=300,
+    ).stdout)
+
+
+# The benchmark runs only while no attempt is being tested, and new ones wait for it to finish,
+# so that it neither slows the solutions down nor is slowed down by them.
+_condition = threading.Condition()
+_testing = 0
+_benchmarking = False
+
+
+@contextlib.contextmanager
+def testing():
+    """
+    Wraps the acquisition and the testing of an attempt by a worker.
+    """
+
+    global _testing
+    with _condition:
+        while _benchmarking:
+            _condition.wait(1) # Not to defer an interruption of the worker for long.
+        _testing += 1
+    try:
+        yield
+    finally:
+        with _condition:
+            _testing -= 1
+            _condition.notify_all()
+
+
+def enabled(cnf):
+    return (cnf.get("calibration") or { }).get("reference") is not None
+
+
+class Calibrator:
+    """
+    Sets cnf["behaviour"]["time_multiplier"] to the reference time of the benchmark divided by
+    the time on this node, measured on creation and every `interval` seconds thereafter, so that
+    slowdowns under load are taken into account too. The testing pauses while the benchmark runs.
+    """
+
+    def __init__(self, cnf):
+        self._cnf = cnf
+        self._thread = None
+        self._stopped = threading.Event()
+        if not enabled(cnf):
+            return
+
+        calibration_cnf = cnf["calibration"]
+        self._reference = calibration_cnf["reference"]
+        self._runs = calibration_cnf.get("runs", 3)
+        self._tolerance = calibration_cnf.get("tolerance", .05)
+        self._calibrate()
+        self._thread = threading.Thread(
+            target=self._run, args=(calibration_cnf.get("interval", 600), ), daemon=True)
+        self._thread.start()
+
+    def _calibrate(self):
+        global _benchmarking
+        with _condition:
+            _benchmarking = True
+            while _testing and not self._stopped.is_set():
+                _condition.wait(1)
+        try:
+            if self._stopped.is_set():
+                return
+            times = sorted(benchmark() for _ in range(self._runs))
+        except (OSError, ValueError, subprocess.SubprocessError) as e:
+            print("Cannot calibrate the time multiplier: %s" % e, flush=True)
+            return
+        finally:
+            with _condition:
+                _benchmarking = False
+                _condition.notify_all()
+
+        # Rounded, and changed only noticeably, to keep the fingerprints of results stable.
+        multiplier = round(self._reference / times[len(times) // 2] * 20) / 20
+        current = self._cnf["behaviour"]["time_multiplier"]
+        if multiplier > 0 and abs(multiplier - current) > self._tolerance * current:
+            self._cnf["behaviour"]["time_multiplier"] = multiplier
+            print("Time multiplier: %g" % multiplier, flush=True)
+
+    def _run(self, interval):
+        while not self._stopped.wait(interval):
+            self._calibrate()
+
+    def close(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+
+
+def main():
+    docopt.docopt(__doc__)
+    print("%.3f" % workload())
+
+
+if __name__ == "__main__":
+    main()
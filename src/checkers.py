@@ -0,0 +1,117 @@
+"""
+Long-lived checker processes.
+
+A checker that opts in (see `checker_servers` in the config) is started once with no extra
+arguments, in the problem directory, and is then fed requests through its stdin:
+
+    <input file>\\n<output file>\\n<answer file>\\n
+
+For each request it must write to its stdout a line with its testlib exit code and the length
+of its comment in bytes, followed by the comment itself:
+
+    <exit code> <length>\\n<comment>
+"""
+
+import collections
+import os
+import subprocess
+import threading
+
+
+class ProtocolError(Exception):
+    pass
+
+
+class CheckerServer:
+    def __init__(self, args, cwd):
+        self._proc = subprocess.Popen(
+            args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, cwd=cwd)
+
+    def close(self):
+        self._proc.stdin.close()
+        try:
+            self._proc.wait(timeout=1)
+        except subprocess.TimeoutExpired:
+            self._proc.kill()
+            self._proc.wait()
+        self._proc.stdout.close()
+
+    def check(self, input_file, output_file, answer_file, max_comment_size=None) -> (int, bytes):
+        try:
+            self._proc.stdin.write(b"".join(
+                os.fsencode(name) + b"\n" for name in (input_file, output_file, answer_file)))
+            self._proc.stdin.flush()
+            header = self._proc.stdout.readline().split()
+        except OSError as e:
+            raise ProtocolError("Checker server has died") from e
+        try:
+            returncode, length = map(int, header)
+        except ValueError:
+            raise ProtocolError("Checker server sent malformed header: %r" % header)
+        if length < 0:
+            raise ProtocolError("Checker server sent malformed header: %r" % header)
+        kept = length if max_comment_size is None else min(length, max_comment_size)
+        comment = self._proc.stdout.read(kept)
+        received = len(comment)
+        # Discard the rest without keeping it in memory.
+        while received < length:
+            chunk = self._proc.stdout.read(min(length - received, 2 ** 16))
+            if not chunk:
+                break
+            received += len(chunk)
+        if received != length:
+            raise ProtocolError("Checker server has died")
+        return returncode, comment
+
+
+class ServerPool:
+    """
+    Keeps idle checker servers for reuse. Thread-safe; at most `max_idle` servers are kept.
+    """
+
+    def __init__(self, max_idle):
+        self._max_idle = max_idle
+        self._idle = collections.OrderedDict() # (key, id) -> server, least recently used first.
+        self._lock = threading.Lock()
+
+    def check(
+        self, key, args, cwd, input_file, output_file, answer_file, max_comment_size=None,
+    ) -> (int, bytes):
+        """
+        Runs a check on an idle server with the given key (the checker's path, mtime and
+        directory), or on a new one. Keeps at most `max_comment_size` bytes of the comment.
+        """
+
+        server = None
+        with self._lock:
+            for idle_key in self._idle:
+                if idle_key[0] == key:
+                    server = self._idle.pop(idle_key)
+                    break
+        if server is None:
+            server = CheckerServer(args, cwd)
+
+        try:
+            result = server.check(input_file, output_file, answer_file, max_comment_size)
+        except:
+            server.close()
+            raise
+
+        evicted = [ ]
+        with self._lock:
+            self._idle[key, id(server)] = server
+            while len(self._idle) > self._max_idle:
+                evicted.append(self._idle.popitem(last=False)[1])
+        for server in evicted:
+            server.close()
+        return result
+
+    def close(self):
+        with self._lock:
+            servers = list(self._idle.values())
+            self._idle.clear()
+        for server in servers:
+            server.close()
+
+
+servers = ServerPool(8)
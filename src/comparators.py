@@ -0,0 +1,406 @@
+"""
+In-process replacements for the most common checkers, which save a process per test. They read
+both files in chunks; `tokens`, `lines` and `floats` report the same verdicts with the same
+comments as testlib's wcmp, lcmp and rcmp.
+"""
+
+import itertools
+import math
+import re
+
+from verdict import Verdict
+
+
+CHUNK_SIZE = 64 * 1024
+
+
+def _compress(token: bytes) -> str:
+    token = token.replace(b"\0", b"~")
+    if len(token) > 64:
+        token = token[:30] + b"..." + token[-31:]
+    return token.decode(errors="surrogateescape")
+
+
+def _english_ending(n):
+    if n // 10 % 10 != 1:
+        if n % 10 == 1:
+            return "st"
+        if n % 10 == 2:
+            return "nd"
+        if n % 10 == 3:
+            return "rd"
+    return "th"
+
+
+def _comment(prefix, message):
+    return ("%s %s\n" % (prefix, message)).encode(errors="surrogateescape")
+
+
+def _ok(message):
+    return Verdict.OK, _comment("ok", message)
+
+
+def _wa(message):
+    return Verdict.WA, _comment("wrong answer", message)
+
+
+def _pe(message):
+    return Verdict.PE, _comment("wrong output format", message)
+
+
+def _fail(message):
+    # The answer is broken, so the checker itself has failed.
+    return Verdict.SE, _comment("FAIL", message)
+
+
+_CARRIAGE_RETURN = re.compile(rb"\r(.)", re.DOTALL)
+# As testlib's readWord, which, unlike lcmp's stringstream, takes \v and \f for parts of a token.
+_WORD = re.compile(rb"[^ \t\r\n]+")
+
+
+def _split_words(data):
+    if b"\v" in data or b"\f" in data:
+        return _WORD.findall(data)
+    return data.split()
+
+
+def _words(chunks, split=bytes.split):
+    tail = b""
+    for chunk in chunks:
+        if not chunk:
+            continue
+        words = split(tail + chunk)
+        tail = words.pop() if words and split(chunk[-1:]) else b""
+        yield from words
+    if tail:
+        yield tail
+
+
+def _tokens(f):
+    return _words(iter(lambda: f.read(CHUNK_SIZE), b""), _split_words)
+
+
+def _without_carriage_returns(piece):
+    # Also tells if the piece ends with a CR, which takes the character after it.
+    if b"\r" not in piece:
+        return piece, False
+    carriage_return = (len(piece) - len(piece.rstrip(b"\r"))) % 2 == 1
+    if carriage_return:
+        piece = piece[:-1]
+    return _CARRIAGE_RETURN.sub(rb"\1", piece), carriage_return
+
+
+class _LongLine:
+    """
+    A line that does not fit in the buffer: it is split into tokens while it is read, keeping
+    only as much of its text as the comments show.
+    """
+
+    def __init__(self, pieces):
+        self._head = self._tail = b""
+        self._length = 0
+        self.tokens = _words(self._watch(pieces))
+
+    def _watch(self, pieces):
+        for piece in pieces:
+            if len(self._head) < 64:
+                self._head += piece[:64 - len(self._head)]
+            self._tail = (self._tail + piece[-31:])[-31:]
+            self._length += len(piece)
+            yield piece
+
+    def skip(self):
+        for _ in self.tokens:
+            pass
+
+    def __str__(self):
+        if self._length > 64:
+            return _compress(self._head[:30] + b"..." + self._tail)
+        return _compress(self._head)
+
+
+def _same_tokens(expected, found):
+    if isinstance(expected, bytes) and isinstance(found, bytes):
+        return expected.split() == found.split()
+    expected_tokens = iter(expected.split()) if isinstance(expected, bytes) else expected.tokens
+    found_tokens = iter(found.split()) if isinstance(found, bytes) else found.tokens
+    if all(e == f for e, f in itertools.zip_longest(expected_tokens, found_tokens)):
+        return True
+    for line in (expected, found):
+        if isinstance(line, _LongLine):
+            line.skip()
+    return False
+
+
+def _line_text(line):
+    return _compress(line) if isinstance(line, bytes) else str(line)
+
+
+class _Lines:
+    """
+    Reads a file in chunks line by line as testlib's readString does: up to LF or CR LF, dropping
+    any other CR together with taking the character after it as is. Lines that fit in the buffer
+    are read as bytes, longer ones as _LongLine.
+    """
+
+    def __init__(self, f):
+        self._f = f
+        self._lines = [ ] # In reverse order.
+        self._rest = b""
+        self._eof = False
+
+    def _read(self):
+        chunk = self._f.read(CHUNK_SIZE)
+        self._eof = not chunk
+        return chunk
+
+    def _in_long_line(self):
+        # A CR alone may yet turn out to end an empty line.
+        return len(self._rest) >= CHUNK_SIZE and b"\n" not in self._rest and self._rest != b"\r"
+
+    def _read_ahead(self):
+        while not self._lines and not self._eof and not self._in_long_line():
+            data = self._rest + self._read()
+            lines = data.split(b"\n")
+            self._rest = lines.pop()
+            if b"\r" in data:
+                lines = [_without_carriage_returns(line)[0] for line in lines]
+            lines.reverse()
+            self._lines = lines
+
+    def eof(self):
+        self._read_ahead()
+        return not self._lines and not self._rest
+
+    def last_is_empty(self):
+        self._read_ahead()
+        if self._lines != [b""]:
+            return False
+        if not self._rest and not self._eof:
+            self._rest = self._read()
+        return not self._rest
+
+    def seek_eof(self):
+        if any(_WORD.search(line) for line in self._lines) or _WORD.search(self._rest):
+            return False
+        return not _has_more_tokens(_tokens(self._f))
+
+    def read(self):
+        self._read_ahead()
+        if self._lines:
+            return self._lines.pop()
+        if not self._eof:
+            return _LongLine(self._pieces())
+        text, carriage_return = _without_carriage_returns(self._rest)
+        self._rest = b""
+        return text + b"\xff" if carriage_return else text # What testlib takes for EOF.
+
+    def _pieces(self):
+        carriage_return = False
+        while True:
+            if not self._rest and not self._eof:
+                self._rest = self._read()
+            if not self._rest:
+                if carriage_return:
+                    yield b"\xff"
+                return
+            if carriage_return:
+                carriage_return = False
+                first, self._rest = self._rest[:1], self._rest[1:]
+                if first == b"\n":
+                    return
+                yield first
+                continue
+            piece, end, self._rest = self._rest.partition(b"\n")
+            piece, carriage_return = _without_carriage_returns(piece)
+            yield piece
+            if end:
+                return
+
+
+def _has_more_tokens(tokens):
+    return next(tokens, None) is not None
+
+
+def exact(output_file, answer_file) -> (Verdict, bytes):
+    """
+    Compares the files byte by byte.
+    """
+
+    offset = lines = 0
+    with open(output_file, "rb") as output, open(answer_file, "rb") as answer:
+        while True:
+            expected = answer.read(CHUNK_SIZE)
+            found = output.read(CHUNK_SIZE)
+            if expected != found:
+                i = 0
+                while i < min(len(expected), len(found)) and expected[i] == found[i]:
+                    i += 1
+                return _wa("files differ at byte %d (line %d)" % (
+                    offset + i + 1, lines + expected.count(b"\n", 0, i) + 1))
+            if not expected:
+                return _ok("%d bytes" % offset)
+            offset += len(expected)
+            lines += expected.count(b"\n")
+
+
+def tokens(output_file, answer_file) -> (Verdict, bytes):
+    """
+    Compares the sequences of whitespace-separated tokens (wcmp).
+    """
+
+    n = 0
+    with open(output_file, "rb") as output, open(answer_file, "rb") as answer:
+        found_tokens = _tokens(output)
+        for expected in _tokens(answer):
+            found = next(found_tokens, None)
+            if found is None:
+                return _wa("Unexpected EOF in the participants output")
+            n += 1
+            if expected != found:
+                return _wa("%d%s words differ - expected: '%s', found: '%s'" % (
+                    n, _english_ending(n), _compress(expected), _compress(found)))
+        if _has_more_tokens(found_tokens):
+            return _wa("Participant output contains extra tokens")
+    if n == 1:
+        return _ok('"%s"' % _compress(expected))
+    return _ok("%d tokens" % n)
+
+
+def lines(output_file, answer_file) -> (Verdict, bytes):
+    """
+    Compares the files line by line, each line as a sequence of tokens (lcmp).
+    """
+
+    n = 0
+    with open(output_file, "rb") as output, open(answer_file, "rb") as answer:
+        found_lines = _Lines(output)
+        expected_lines = _Lines(answer)
+        while not expected_lines.eof():
+            if expected_lines.last_is_empty():
+                break # An empty last line of the answer is not compared.
+            expected = expected_lines.read()
+            found = found_lines.read()
+            n += 1
+            if not _same_tokens(expected, found):
+                return _wa("%d%s lines differ - expected: '%s', found: '%s'" % (
+                    n, _english_ending(n), _line_text(expected), _line_text(found)))
+            last = expected
+        if not found_lines.seek_eof():
+            return _pe("Extra information in the output file")
+    if n == 1:
+        return _ok("single line: '%s'" % _line_text(last))
+    return _ok("%d lines" % n)
+
+
+def _abs(x):
+    # As testlib's, which keeps the sign of a zero or a NaN it is given.
+    return x if x > 0 else -x
+
+
+def _double_compare(expected, result, eps):
+    eps += 1e-15
+    if _abs(result - expected) <= eps: # Never true unless both are finite.
+        return True
+    if math.isnan(expected):
+        return math.isnan(result)
+    if math.isinf(expected):
+        return expected == result
+    if math.isnan(result) or math.isinf(result):
+        return False
+    bounds = sorted((expected * (1 - eps), expected * (1 + eps)))
+    return bounds[0] <= result <= bounds[1]
+
+
+def _double_delta(expected, result):
+    absolute = _abs(result - expected)
+    if _abs(expected) > 1e-9:
+        relative = _abs(absolute / expected)
+        return absolute if absolute < relative else relative
+    return absolute
+
+
+def _format(x, digits):
+    if math.isnan(x):
+        return "-nan" if math.copysign(1, x) < 0 else "nan"
+    return "%.*f" % (digits, x)
+
+
+# The numbers testlib's readDouble accepts: no hexadecimal, infinities, NaNs or underscores, but
+# an overflow is read as an infinity, and a dangling exponent, as glibc's scanf does, as none.
+_DOUBLE = re.compile(rb"([+-]?(\d+\.?\d*|\.\d+))([eE][+-]?\d*)?")
+
+
+def _double(token):
+    match = _DOUBLE.fullmatch(token)
+    if match is None:
+        return None
+    try:
+        return float(token)
+    except ValueError: # A dangling exponent.
+        return float(match.group(1))
+
+
+def floats(output_file, answer_file, eps, digits) -> (Verdict, bytes):
+    """
+    Compares sequences of floating-point numbers with the given absolute or relative error (rcmp),
+    showing them with the given number of digits after the point.
+    """
+
+    n = 0
+    with open(output_file, "rb") as output, open(answer_file, "rb") as answer:
+        found_tokens = _tokens(output)
+        for token in _tokens(answer):
+            expected = _double(token)
+            if expected is None:
+                return _fail('Expected double in the answer, but "%s" found' % _compress(token))
+            token = next(found_tokens, None)
+            if token is None:
+                return _pe("Unexpected end of file - double expected")
+            found = _double(token)
+            if found is None:
+                return _pe('Expected double, but "%s" found%s' % (
+                    _compress(token), " (it contains \\0)" if b"\0" in token else ""))
+            n += 1
+            if not _double_compare(expected, found, eps):
+                return _wa("%d%s numbers differ - expected: '%s', found: '%s', error = '%s'" % (
+                    n, _english_ending(n), _format(expected, digits), _format(found, digits),
+                    _format(_double_delta(expected, found), digits)))
+        if _has_more_tokens(found_tokens):
+            return _pe("Extra information in the output file")
+    if n == 1:
+        return _ok("found '%s', expected '%s', error '%s'" % (
+            _format(found, digits), _format(expected, digits),
+            _format(_double_delta(expected, found), digits)))
+    return _ok("%d numbers" % n)
+
+
+def get(spec):
+    """
+    Takes a comparator specification, such as "tokens" or "floats 1e-6", from the config. Floats
+    are shown with one digit more than the error has, as rcmp6 and rcmp9 do, unless the number of
+    digits is given after it, e.g. "floats 1.5e-6 10" for rcmp.
+    Returns a function of (output file, answer file), which reports SE if a file cannot be read.
+    """
+
+    name, *args = spec.split()
+    if name == "exact" and not args:
+        compare = exact
+    elif name == "tokens" and not args:
+        compare = tokens
+    elif name == "lines" and not args:
+        compare = lines
+    elif name == "floats" and len(args) in (1, 2):
+        eps = float(args[0])
+        digits = int(args[1]) if len(args) == 2 else round(-math.log10(eps)) + 1
+        compare = lambda output_file, answer_file: floats(output_file, answer_file, eps, digits)
+    else:
+        raise ValueError("Unknown comparator: %s" % spec)
+
+    def guarded(output_file, answer_file):
+        try:
+            return compare(output_file, answer_file)
+        except OSError as e:
+            return _fail(str(e))
+
+    return guarded
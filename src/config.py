@@ -1,4 +1,9 @@
+import ctypes
+import ctypes.util
+import os
 import pathlib
+import struct
+import threading
 import yaml
 
 
@@ -12,6 +17,15 @@ def resolve_dirs(dirs):
             raise FileNotFoundError(path)
         dirs[key] = path
 
+    # Optional directory for the testers' caches.
+    path = dirs.get("cache")
+    if path:
+        path = pathlib.Path(path).expanduser()
+        path.mkdir(parents=True, exist_ok=True)
+        dirs["cache"] = path.resolve()
+    else:
+        dirs["cache"] = None
+
 
 def collect_executables(path) -> { str: str }:
     """
@@ -42,3 +56,87 @@ def read(filename):
         key: collect_executables(cnf["dirs"][key]) for key in ("compilers", "runners", "checkers")
     }
     return cnf
+
+
+class ExecutablesWatcher:
+    """
+    Keeps cnf["exec"] up to date with the contents of the compilers, runners and checkers
+    directories. Uses inotify if possible, and compares the directories' mtimes otherwise.
+    """
+
+    _KEYS = ("compilers", "runners", "checkers")
+    # IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+    _EVENTS = 0x4 | 0x8 | 0x40 | 0x80 | 0x100 | 0x200
+    _EVENT = struct.Struct("iIII") # wd, mask, cookie, len; followed by the name.
+
+    def __init__(self, cnf):
+        self._cnf = cnf
+        self._lock = threading.Lock()
+        self._fd = -1
+        self._keys_by_wd = { }
+        self._stamps = { key: self._stamp(key) for key in self._KEYS }
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        try:
+            self._fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        except AttributeError:
+            return # Not Linux.
+        for key in self._KEYS:
+            wd = libc.inotify_add_watch(
+                self._fd, str(cnf["dirs"][key]).encode(), self._EVENTS)
+            if wd < 0:
+                self.close()
+                return
+            self._keys_by_wd[wd] = key
+
+    def _stamp(self, key):
+        return os.stat(str(self._cnf["dirs"][key])).st_mtime_ns
+
+    def _changed(self) -> {str}:
+        if self._fd < 0:
+            changed = { key for key in self._KEYS if self._stamp(key) != self._stamps[key] }
+        else:
+            changed = set()
+            while True:
+                try:
+                    buf = os.read(self._fd, 65536)
+                except BlockingIOError:
+                    break
+                offset = 0
+                while offset < len(buf):
+                    wd, _, _, length = self._EVENT.unpack_from(buf, offset)
+                    offset += self._EVENT.size + length
+                    if wd < 0: # The event queue has overflowed.
+                        changed.update(self._KEYS)
+                    else:
+                        changed.add(self._keys_by_wd[wd])
+        for key in changed:
+            self._stamps[key] = self._stamp(key)
+        return changed
+
+    def fileno(self):
+        """
+        Returns a descriptor that becomes readable when the directories change, if there is one.
+        """
+
+        return self._fd if self._fd >= 0 else None
+
+    def refresh(self):
+        """
+        Rescans the directories that have changed since the last call.
+        """
+
+        with self._lock:
+            for key in self._changed():
+                try:
+                    executables = collect_executables(self._cnf["dirs"][key])
+                except (FileExistsError, FileNotFoundError) as e:
+                    print("Keeping the old list of %s: %s" % (key, e), flush=True)
+                    continue
+                if executables != self._cnf["exec"][key]:
+                    self._cnf["exec"][key] = executables
+                    print("Reloaded the list of %s" % key, flush=True)
+
+    def close(self):
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
@@ -1,10 +1,96 @@
+import concurrent.futures
+import math
+import select
+import threading
+import time
+
 import postgresql.exceptions
+import metrics
 import models
 
 
+# postgresql.open() imports its dependencies lazily, which is not thread-safe.
+_open_lock = threading.Lock()
+
+
+# Keys to order the queue of untested attempts by.
+_QUEUE_KEYS = {
+    # Attempts that have never been tested go before rejudged ones.
+    "live": "a.tester_name IS NOT NULL",
+    "time": "a.time",
+}
+# Round-robin across these, by the order of the keys above.
+_QUEUE_PARTITIONS = {
+    "contest": "pic.contest_id",
+    "user": "a.user_id",
+}
+
+_IN_PROGRESS = "(result IN ('Queued', 'Compiling...') OR result LIKE 'Testing...%')"
+
+# In a fleet, an attempt belongs to the tester whose status lists it: names need not be unique.
+_HELD_BY = """EXISTS (
+    SELECT 1 FROM checker_statuses s WHERE s.id = %s AND attempts.id = ANY(s.attempt_ids)
+)"""
+
+
+def _queue_query(queue_order, max_attempts_per_user) -> (str, str, str):
+    """
+    Returns a query of the untested attempts with the given compilers ($1) and runners ($2)
+    and the keys to order them by, then an ORDER BY clause and a WHERE condition on its result.
+    """
+
+    if "time" not in queue_order:
+        queue_order = list(queue_order) + ["time"]
+    within_partition = ", ".join(_QUEUE_KEYS[key] for key in queue_order if key in _QUEUE_KEYS)
+    columns = ["a.id"]
+    for i, key in enumerate(queue_order):
+        if key in _QUEUE_KEYS:
+            columns.append("%s AS k%d" % (_QUEUE_KEYS[key], i))
+        elif key in _QUEUE_PARTITIONS:
+            columns.append("row_number() OVER (PARTITION BY %s ORDER BY %s) AS k%d" % (
+                _QUEUE_PARTITIONS[key], within_partition, i))
+        else:
+            raise ValueError("Unknown queue order key: %s" % key)
+    order_by = ", ".join("q.k%d" % i for i in range(len(queue_order)))
+
+    if max_attempts_per_user:
+        columns.append("row_number() OVER (PARTITION BY a.user_id ORDER BY %s) AS user_rank" % (
+            within_partition))
+        columns.append(
+            "(SELECT count(*) FROM attempts WHERE user_id = a.user_id AND " + _IN_PROGRESS +
+            ") AS user_load")
+        cap = "q.user_rank + q.user_load <= %d" % max_attempts_per_user
+    else:
+        cap = "TRUE"
+
+    candidates = """
+        SELECT %s
+        FROM attempts a
+        JOIN compilers comp ON comp.id = a.compiler_id
+        JOIN problem_in_contests pic ON pic.id = a.problem_in_contest_id
+        WHERE (a.result IS NULL OR a.result = '') -- TODO: Drop `a.result IS NULL`.
+        AND   comp.codename = ANY($1)
+        AND   comp.runner_codename = ANY($2)
+    """ % ", ".join(columns)
+    return candidates, order_by, cap
+
+
 class Connection:
-    def __init__(self, locator):
-        self._db = postgresql.open(locator)
+    def __init__(
+        self, locator, progress_interval=0, queue_order=("time", ), max_attempts_per_user=0,
+    ):
+        with _open_lock:
+            self._db = postgresql.open(locator)
+        self._progress_interval = progress_interval
+        self._last_progress_time = None
+        self._test_infos = [ ]
+        self._fleet_status = None
+        self._fleet_params = None # (tester name, compilers, runners)
+        self._held_attempts = set()
+        self._live_attempts = set() # Claimed attempts that had never been claimed before.
+        self._fingerprints = False
+        self._memoize = False
+        self._attempt_fingerprint = None
 
         self._create_tester_status = self._db.prepare("""
             INSERT INTO checker_statuses (updated_at)
@@ -12,37 +98,44 @@ class Connection:
             RETURNING id
         """)
 
-        self.update_tester_status = self._db.prepare("""
+        self._update_tester_status = self._db.prepare("""
             UPDATE checker_statuses
             SET updated_at = NOW()
             WHERE id = $1
         """)
 
-        self.delete_tester_status = self._db.prepare("""
+        self._delete_tester_status = self._db.prepare("""
             DELETE FROM checker_statuses
             WHERE id = $1
         """)
 
+        candidates, order_by, cap = _queue_query(queue_order, max_attempts_per_user)
         self._get_untested_attempt = self._db.prepare("""
             SELECT
-                a.id, a.source,                                               -- 0:2
-                pic.problem_id, p.name, p.path, p.time_limit, p.memory_limit, -- 2:7
-                p.checker, p.mask_in, p.mask_out,                             -- 7:10
-                pic.contest_id, c.is_school,                                  -- 10:12
-                pic.number,                                                   -- 12:13
-                u.login, u.username,                                          -- 13:15
-                comp.name, comp.codename, comp.runner_codename                -- 15:18
-            FROM attempts a
+                a.id,                                                         -- 0:1
+                pic.problem_id, p.name, p.path, p.time_limit, p.memory_limit, -- 1:6
+                p.checker, p.mask_in, p.mask_out,                             -- 6:9
+                pic.contest_id, c.is_school,                                  -- 9:11
+                pic.number,                                                   -- 11:12
+                u.login, u.username,                                          -- 12:14
+                comp.name, comp.codename, comp.runner_codename,               -- 14:17
+                a.tester_name IS NULL                                         -- 17:18
+            FROM (%s) q
+            JOIN attempts a ON a.id = q.id
             JOIN compilers comp ON comp.id = a.compiler_id
             JOIN users u ON u.id = a.user_id
             JOIN problem_in_contests pic ON pic.id = a.problem_in_contest_id
             JOIN problems p ON p.id = pic.problem_id
             JOIN contests c ON c.id = pic.contest_id
-            WHERE (a.result IS NULL OR a.result = '') -- TODO: Drop `a.result IS NULL`.
-            AND   comp.codename = ANY($1)
-            AND   comp.runner_codename = ANY($2)
-            ORDER BY a.time
+            WHERE %s
+            ORDER BY %s
             LIMIT 1
+        """ % (candidates, cap, order_by))
+
+        self._get_attempt_source = self._db.prepare("""
+            SELECT source
+            FROM attempts
+            WHERE id = $1
         """)
 
         self._acquire_attempt = self._db.prepare("""
@@ -58,6 +151,61 @@ class Connection:
             WHERE id = $1
         """)
 
+        # Claims several attempts at once without blocking concurrent testers.
+        self._acquire_untested_attempts = self._db.prepare("""
+            WITH claimed AS (
+                UPDATE attempts
+                SET tester_name = $3,
+                    result = $4,
+                    error_message = NULL,
+                    checker_comment = '',
+                    used_time = NULL,
+                    used_memory = NULL,
+                    score = NULL,
+                    updated_at = NOW()
+                FROM (
+                    SELECT q.*, a.tester_name IS NULL AS was_live
+                    FROM (%s) q
+                    JOIN attempts a ON a.id = q.id
+                    WHERE (a.result IS NULL OR a.result = '') -- Rechecked after locking.
+                    AND   %s
+                    ORDER BY %s
+                    LIMIT $5
+                    FOR UPDATE OF a SKIP LOCKED
+                ) q
+                WHERE attempts.id = q.id
+                RETURNING q.*
+            )
+            SELECT
+                a.id,                                                         -- 0:1
+                pic.problem_id, p.name, p.path, p.time_limit, p.memory_limit, -- 1:6
+                p.checker, p.mask_in, p.mask_out,                             -- 6:9
+                pic.contest_id, c.is_school,                                  -- 9:11
+                pic.number,                                                   -- 11:12
+                u.login, u.username,                                          -- 12:14
+                comp.name, comp.codename, comp.runner_codename,               -- 14:17
+                q.was_live                                                    -- 17:18
+            FROM claimed q
+            JOIN attempts a ON a.id = q.id
+            JOIN compilers comp ON comp.id = a.compiler_id
+            JOIN users u ON u.id = a.user_id
+            JOIN problem_in_contests pic ON pic.id = a.problem_in_contest_id
+            JOIN problems p ON p.id = pic.problem_id
+            JOIN contests c ON c.id = pic.contest_id
+            ORDER BY %s
+        """ % (candidates, cap, order_by, order_by))
+
+        # Live attempts ($4) get their NULL tester_name back, so that they still rank as live.
+        self._release_attempts = self._db.prepare("""
+            UPDATE attempts
+            SET result = '',
+                tester_name = CASE WHEN id = ANY($4) THEN NULL ELSE tester_name END,
+                updated_at = NOW()
+            WHERE id = ANY($1)
+            AND   tester_name = $2
+            AND   result = $3
+        """)
+
         self.update_attempt_result = self._db.prepare("""
             UPDATE attempts
             SET result = $2,
@@ -102,7 +250,20 @@ class Connection:
             WHERE id = $1
         """)
 
-        self.create_test_info = self._db.prepare("""
+        # When a contest starts, all of its problems become hot with the first submissions.
+        self._get_hot_problem_paths = self._db.prepare("""
+            SELECT DISTINCT p.path
+            FROM problem_in_contests pic
+            JOIN problems p ON p.id = pic.problem_id
+            WHERE pic.contest_id IN (
+                SELECT pic.contest_id
+                FROM attempts a
+                JOIN problem_in_contests pic ON pic.id = a.problem_in_contest_id
+                WHERE a.result IS NULL OR a.result = '' -- As lerna_attempts_untested.
+            )
+        """)
+
+        self._create_test_info = self._db.prepare("""
             INSERT INTO test_infos
                 (attempt_id, test_number, result, used_time, used_memory, checker_comment)
             VALUES ($1, $2, $3, $4, $5, $6)
@@ -111,9 +272,421 @@ class Connection:
     def close(self):
         self._db.close()
 
+    def fileno(self):
+        return self._db.fileno()
+
+    def listen(self, channel):
+        # The connection may have been listening on another channel before a restart.
+        self.unlisten()
+        self._db.listen(channel)
+
+    def unlisten(self):
+        """
+        Stops listening on any channel and drops the notifications received so far.
+        """
+
+        self._db.execute("UNLISTEN *")
+        for _ in self._db.iternotifies(0):
+            pass
+
+    def receive_notifications(self) -> int:
+        """
+        Returns the number of notifications received since the last call.
+        """
+
+        if select.select([self._db.fileno()], [], [], 0)[0]:
+            self._db.execute("") # Make the driver read the pending messages.
+        return sum(1 for _ in self._db.iternotifies(0))
+
+    def install_queue_indexes(self):
+        """
+        Creates partial indexes on the untested and the being tested attempts, which keep
+        the queue queries fast regardless of the number of attempts.
+        """
+
+        # Concurrently, so as not to block the site; cannot be done in a transaction.
+        self._db.execute("""
+            CREATE INDEX CONCURRENTLY IF NOT EXISTS lerna_attempts_untested
+            ON attempts (time)
+            WHERE result IS NULL OR result = ''
+        """)
+        self._db.execute("""
+            CREATE INDEX CONCURRENTLY IF NOT EXISTS lerna_attempts_in_progress
+            ON attempts (user_id)
+            WHERE %s
+        """ % _IN_PROGRESS)
+
+    def _require_columns(self, *columns):
+        """
+        Takes "table.column" names. The tester does not change the site's schema by itself.
+        """
+
+        present = { row[0] for row in self._db.prepare("""
+            SELECT table_name || '.' || column_name
+            FROM information_schema.columns
+            WHERE table_name || '.' || column_name = ANY($1)
+        """)(list(columns)) }
+        missing = [column for column in columns if column not in present]
+        if missing:
+            raise RuntimeError(
+                "Missing columns %s; apply schema.sql to the database" % ", ".join(missing))
+
     def create_tester_status(self):
         return self._create_tester_status.first()
 
+    def enable_test_fingerprints(self):
+        """
+        Makes `add_test_info` store the fingerprints of tests along with their results.
+        Requires the column added by schema.sql.
+        """
+
+        self._require_columns("test_infos.fingerprint")
+
+        self._create_test_info = self._db.prepare("""
+            INSERT INTO test_infos (
+                attempt_id, test_number, result, used_time, used_memory, checker_comment,
+                fingerprint
+            )
+            VALUES ($1, $2, $3, $4, $5, $6, $7)
+        """)
+
+        self._get_test_infos = self._db.prepare("""
+            SELECT DISTINCT ON (test_number)
+                test_number, result, used_time, used_memory, checker_comment, fingerprint
+            FROM test_infos
+            WHERE attempt_id = $1
+            AND   fingerprint IS NOT NULL
+            ORDER BY test_number, id DESC
+        """)
+        self._fingerprints = True
+
+    def enable_time_multiplier_reporting(self):
+        """
+        Makes `update_tester_status_with_multiplier` usable.
+        Requires the column added by schema.sql.
+        """
+
+        self._require_columns("checker_statuses.time_multiplier")
+
+        self._update_tester_status_with_multiplier = self._db.prepare("""
+            UPDATE checker_statuses
+            SET updated_at = NOW(),
+                time_multiplier = $2
+            WHERE id = $1
+        """)
+
+    def enable_result_memoization(self):
+        """
+        Makes `finish_attempt` store the fingerprint of the attempt set by
+        `set_attempt_fingerprint`, or NULL, along with its result, so that
+        `find_memoized_result` can find identical attempts. Requires the column (and, for speed,
+        the index) added by schema.sql.
+        """
+
+        self._require_columns("attempts.fingerprint")
+
+        self._set_attempt_fingerprint = self._db.prepare("""
+            UPDATE attempts
+            SET fingerprint = $2
+            WHERE id = $1
+        """)
+
+        self._find_memoized_result = self._db.prepare("""
+            SELECT id, result, used_time, used_memory, score
+            FROM attempts
+            WHERE fingerprint = $1
+            AND   id <> $2
+            AND   result <> ''
+            AND   result NOT LIKE 'System error%%'
+            AND   NOT %s
+            ORDER BY updated_at DESC
+            LIMIT 1
+        """ % _IN_PROGRESS)
+
+        self._copy_test_infos = self._db.prepare("""
+            INSERT INTO test_infos
+                (attempt_id, test_number, result, used_time, used_memory, checker_comment)
+            SELECT DISTINCT ON (test_number)
+                $1, test_number, result, used_time, used_memory, checker_comment
+            FROM test_infos
+            WHERE attempt_id = $2
+            ORDER BY test_number, id DESC
+        """)
+
+        self._copy_attempt_result = self._db.prepare("""
+            UPDATE attempts
+            SET result = s.result,
+                used_time = s.used_time,
+                used_memory = s.used_memory,
+                score = s.score,
+                checker_comment = s.checker_comment,
+                updated_at = NOW()
+            FROM attempts s
+            WHERE attempts.id = $1
+            AND   s.id = $2
+        """)
+        self._memoize = True
+
+    def set_attempt_fingerprint(self, fingerprint):
+        """
+        Buffers the fingerprint of the attempt being tested until it is finished.
+        """
+
+        self._attempt_fingerprint = fingerprint
+
+    def find_memoized_result(self, fingerprint, attempt_id) -> tuple:
+        """
+        Returns (id, result, used time, used memory, score) of the latest tested attempt with
+        the given fingerprint other than the given one, or None.
+        """
+
+        return self._find_memoized_result.first(fingerprint, attempt_id)
+
+    def copy_result(self, attempt_id, source_id):
+        """
+        Gives the attempt the result and the test infos of another one.
+        Meant to be passed to `finish_attempt`.
+        """
+
+        self._copy_test_infos(attempt_id, source_id)
+        self._copy_attempt_result(attempt_id, source_id)
+
+    def get_test_infos(self, attempt_id) -> { int: tuple }:
+        """
+        Returns the latest fingerprinted results of the attempt's tests:
+        {test number: (result, used time, used memory, checker comment, fingerprint)}.
+        """
+
+        return { row[0]: tuple(row[1:]) for row in self._get_test_infos(attempt_id) }
+
+    def get_hot_problem_paths(self) -> [str]:
+        """
+        Returns the paths of the problems of the contests that have untested attempts.
+        """
+
+        return [row[0] for row in self._get_hot_problem_paths()]
+
+    def delete_tester_status(self, status):
+        self._delete_tester_status(status)
+        if status == self._fleet_status:
+            self._fleet_status = None
+            self._held_attempts.clear()
+
+    def join_fleet(self, tester_name, available_compilers, available_runners):
+        """
+        Creates a tester status that also tells what the tester can test and which attempts it
+        holds, so that other testers can reclaim them if it stops responding.
+        Requires the columns added by schema.sql.
+        """
+
+        self._require_columns(
+            "checker_statuses.tester_name",
+            "checker_statuses.compilers",
+            "checker_statuses.runners",
+            "checker_statuses.attempt_ids",
+            "checker_statuses.live_attempt_ids",
+            "attempts.retries",
+        )
+
+        self._hold_attempts = self._db.prepare("""
+            UPDATE checker_statuses
+            SET attempt_ids = $2,
+                live_attempt_ids = $3,
+                updated_at = NOW()
+            WHERE id = $1
+        """)
+
+        # Requeues the unfinished attempts of testers whose heartbeat is older than $1 seconds.
+        self._reclaim_attempts = self._db.prepare("""
+            WITH dead AS (
+                DELETE FROM checker_statuses
+                WHERE updated_at < NOW() - $1::float8 * interval '1 second'
+                AND   tester_name IS NOT NULL
+                RETURNING attempt_ids, live_attempt_ids
+            )
+            UPDATE attempts a
+            SET result = CASE WHEN a.retries < $2 THEN '' ELSE 'System error' END,
+                tester_name = CASE
+                    WHEN a.id = ANY(dead.live_attempt_ids) THEN NULL
+                    ELSE a.tester_name
+                END,
+                retries = a.retries + 1,
+                updated_at = NOW()
+            FROM dead
+            WHERE a.id = ANY(dead.attempt_ids)
+            AND   (a.result IN ('Queued', 'Compiling...') OR a.result LIKE 'Testing...%')
+            RETURNING a.id
+        """)
+
+        self._get_fleet_load = self._db.prepare("""
+            SELECT
+                (
+                    SELECT count(*)
+                    FROM attempts a
+                    JOIN compilers comp ON comp.id = a.compiler_id
+                    WHERE (a.result IS NULL OR a.result = '') -- TODO: Drop `a.result IS NULL`.
+                    AND   comp.codename = ANY($1)
+                    AND   comp.runner_codename = ANY($2)
+                ),
+                (
+                    SELECT count(*)
+                    FROM checker_statuses
+                    WHERE updated_at >= NOW() - $3::float8 * interval '1 second'
+                    AND   compilers && $1::text[]
+                    AND   runners && $2::text[]
+                )
+        """)
+
+        # Brings back the status of a tester that has been taken for dead, under the same id.
+        self._rejoin_fleet = self._db.prepare("""
+            INSERT INTO checker_statuses
+                (id, updated_at, attempt_ids, live_attempt_ids, tester_name, compilers, runners)
+            VALUES ($1, NOW(), $2, $3, $4, $5, $6)
+        """)
+
+        self._lock_held_attempt = self._db.prepare("""
+            SELECT 1
+            FROM attempts
+            WHERE id = $1
+            AND   %s
+            AND   %s
+            FOR UPDATE
+        """ % (_HELD_BY % "$2", _IN_PROGRESS))
+
+        # Unlike `update_attempt_result_and_stats`, does nothing to reclaimed attempts.
+        self._report_held_progress = self._db.prepare("""
+            UPDATE attempts
+            SET result = $2,
+                used_time = $3,
+                used_memory = $4,
+                updated_at = NOW()
+            WHERE id = $1
+            AND   %s
+            AND   %s
+        """ % (_HELD_BY % "$5", _IN_PROGRESS))
+
+        self._release_held_attempts = self._db.prepare("""
+            UPDATE attempts
+            SET result = '',
+                tester_name = CASE WHEN id = ANY($4) THEN NULL ELSE tester_name END,
+                updated_at = NOW()
+            WHERE id = ANY($1)
+            AND   %s
+            AND   result = $3
+        """ % (_HELD_BY % "$2"))
+
+        self._fleet_params = (tester_name, list(available_compilers), list(available_runners))
+        self._fleet_status = self._db.prepare("""
+            INSERT INTO checker_statuses (updated_at, tester_name, compilers, runners)
+            VALUES (NOW(), $1, $2, $3)
+            RETURNING id
+        """).first(*self._fleet_params)
+        return self._fleet_status
+
+    def _update_held_attempts(self, acquired=(), released=()):
+        held = (self._held_attempts | set(acquired)) - set(released)
+        live = sorted(self._live_attempts & held)
+        if self._hold_attempts(self._fleet_status, sorted(held), live)[1] == 0:
+            # Another tester has deleted our status and requeued the attempts it listed.
+            held = set(acquired)
+            live = sorted(self._live_attempts & held)
+            self._rejoin_fleet(self._fleet_status, sorted(held), live, *self._fleet_params)
+        self._held_attempts = held
+
+    def _check_status(self, status, outcome):
+        if status == self._fleet_status and outcome[1] == 0:
+            # Same as above; the attempts being tested are not ours anymore.
+            self._held_attempts.clear()
+            self._rejoin_fleet(self._fleet_status, [ ], [ ], *self._fleet_params)
+
+    def update_tester_status(self, status):
+        self._check_status(status, self._update_tester_status(status))
+
+    def update_tester_status_with_multiplier(self, status, multiplier):
+        self._check_status(status, self._update_tester_status_with_multiplier(status, multiplier))
+
+    def reclaim_attempts(self, timeout, max_retries) -> int:
+        """
+        Puts the attempts held by testers that have not updated their status for `timeout`
+        seconds back into the queue, or marks them as System error after `max_retries` retries.
+        Returns how many attempts have been reclaimed.
+        """
+
+        return len(self._reclaim_attempts(timeout, max_retries))
+
+    def fair_share(self, available_compilers, available_runners, timeout) -> int:
+        """
+        Returns how many of the untested attempts this tester should take, given how many
+        live testers can test them.
+        """
+
+        untested, testers = self._get_fleet_load.first(
+            list(available_compilers), list(available_runners), timeout)
+        return max(1, math.ceil(untested / max(testers, 1)))
+
+    def report_progress(self, attempt_id, result, used_time, used_memory):
+        """
+        Updates the attempt's intermediate result and stats,
+        unless it has already been done during the last `progress_interval` seconds.
+        """
+
+        now = time.monotonic()
+        if (self._last_progress_time is None or
+            now - self._last_progress_time >= self._progress_interval):
+            self._last_progress_time = now
+            with metrics.timed("db"):
+                if self._fleet_status is None:
+                    self.update_attempt_result_and_stats(
+                        attempt_id, result, used_time, used_memory)
+                    return
+                # Long attempts must not look like the tester has died.
+                self.update_tester_status(self._fleet_status)
+                if attempt_id in self._held_attempts:
+                    self._report_held_progress(
+                        attempt_id, result, used_time, used_memory, self._fleet_status)
+
+    def add_test_info(
+        self, attempt_id, test_number, result, used_time, used_memory, checker_comment,
+        fingerprint=None,
+    ):
+        """
+        Buffers a test_infos row until the attempt is finished.
+        """
+
+        row = (attempt_id, test_number, result, used_time, used_memory, checker_comment)
+        if self._fingerprints:
+            row += (fingerprint, )
+        self._test_infos.append(row)
+
+    def finish_attempt(self, update, *args):
+        """
+        Writes the buffered test infos and calls `update` with `args` in a single transaction.
+        In a fleet, nothing is written if the attempt has been reclaimed by another tester.
+        """
+
+        with metrics.timed("db"), self._db.xact():
+            if self._fleet_status is None or self._lock_held_attempt.first(
+                args[0], self._fleet_status,
+            ):
+                if self._test_infos:
+                    self._create_test_info.load_rows(self._test_infos)
+                update(*args)
+                if self._memoize:
+                    self._set_attempt_fingerprint(args[0], self._attempt_fingerprint)
+            self._live_attempts.discard(args[0])
+            if self._fleet_status is not None:
+                self._update_held_attempts(released=[args[0]])
+        self._test_infos.clear()
+        self._attempt_fingerprint = None
+        self._last_progress_time = None
+
+    def get_attempt_source(self, attempt_id):
+        """
+        Sources are not loaded with attempts, so that the queue does not hold them.
+        """
+
+        return self._get_attempt_source.first(attempt_id)
+
     def acquire_untested_attempt(self, tester_name, result, available_compilers, available_runners):
         while True:
             try:
@@ -122,12 +695,131 @@ class Connection:
                     if res is None:
                         return None
                     self._acquire_attempt(res[0], tester_name, result)
+                    if res[17]:
+                        self._live_attempts.add(res[0])
+                    if self._fleet_status is not None:
+                        self._update_held_attempts(acquired=[res[0]])
             except postgresql.exceptions.SerializationError:
                 pass
             else:
-                problem = models.Problem(*res[2:10])
-                contest = models.Contest(*res[10:12])
-                pic = models.ProblemInContest(problem, contest, res[12])
-                user = models.User(*res[13:15])
-                compiler = models.Compiler(*res[15:18])
-                return models.Attempt(res[0], pic, user, res[1], compiler)
+                return _make_attempt(res)
+
+    def acquire_untested_attempts(
+        self, tester_name, result, available_compilers, available_runners, limit,
+    ):
+        """
+        Claims up to `limit` oldest untested attempts in a single statement, skipping the ones
+        being claimed by other testers at the moment.
+        """
+
+        with self._db.xact():
+            rows = self._acquire_untested_attempts(
+                available_compilers, available_runners, tester_name, result, limit)
+            self._live_attempts.update(res[0] for res in rows if res[17])
+            if self._fleet_status is not None and rows:
+                self._update_held_attempts(acquired=[res[0] for res in rows])
+        return [_make_attempt(res) for res in rows]
+
+    def release_attempts(self, attempt_ids, tester_name, result):
+        """
+        Puts claimed attempts back into the queue unless someone has changed them meanwhile.
+        """
+
+        with self._db.xact():
+            live = [attempt_id for attempt_id in attempt_ids if attempt_id in self._live_attempts]
+            if self._fleet_status is None:
+                self._release_attempts(attempt_ids, tester_name, result, live)
+            else:
+                self._release_held_attempts(attempt_ids, self._fleet_status, result, live)
+                self._update_held_attempts(released=attempt_ids)
+            self._live_attempts.difference_update(attempt_ids)
+
+
+class BackgroundConnection:
+    """
+    Wraps a `Connection`, running its calls in a background thread one at a time, in order.
+    Writes do not wait for completion; if one fails, the following ones are skipped and the
+    error is reraised by the next call.
+    """
+
+    _WRITES = {
+        "update_tester_status",
+        "update_tester_status_with_multiplier",
+        "update_attempt_result",
+        "update_attempt_result_and_error_message",
+        "update_attempt_result_and_stats",
+        "update_attempt_result_and_stats_with_score",
+        "update_attempt_result_and_stats_with_comment",
+        "report_progress",
+        "add_test_info",
+        "set_attempt_fingerprint",
+        "finish_attempt",
+    }
+
+    def __init__(self, db):
+        self._db = db
+        self._executor = concurrent.futures.ThreadPoolExecutor(1)
+        self._error = None
+
+    def _call(self, method, args):
+        if self._error is not None:
+            raise self._error
+        try:
+            return method(*args)
+        except BaseException as e:
+            self._error = e
+            raise
+
+    def __getattr__(self, name):
+        method = getattr(self._db, name)
+        wait = name not in self._WRITES
+
+        def call(*args):
+            if self._error is not None:
+                raise self._error
+            if name == "finish_attempt":
+                # The update is one of our own wrappers and must run within the transaction.
+                args = (getattr(self._db, args[0].__name__), ) + args[1:]
+            future = self._executor.submit(self._call, method, args)
+            if wait:
+                return future.result()
+
+        call.__name__ = name
+        return call
+
+    def fileno(self):
+        return self._db.fileno()
+
+    def detach(self) -> Connection:
+        """
+        Waits for the pending writes and returns the wrapped connection.
+        """
+
+        self._executor.shutdown()
+        if self._error is not None:
+            self._db.close()
+            raise self._error
+        return self._db
+
+    def close(self):
+        # Waits for the pending writes.
+        self._executor.submit(self._db.close).result()
+        self._executor.shutdown()
+
+
+_interned = { }
+
+
+def _intern(value):
+    if len(_interned) >= 10000:
+        _interned.clear()
+    return _interned.setdefault(value, value)
+
+
+def _make_attempt(res):
+    problem = _intern(models.Problem(*res[1:9]))
+    contest = _intern(models.Contest(*res[9:11]))
+    pic = _intern(models.ProblemInContest(problem, contest, res[11]))
+    user = _intern(models.User(*res[12:14]))
+    compiler = _intern(models.Compiler(*res[14:17]))
+    return models.Attempt(res[0], pic, user, None, compiler)
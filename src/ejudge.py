@@ -2,11 +2,15 @@ import verdict
 
 
 class Protocol:
-    def __init__(self, binary_str):
+    def __init__(self, lines):
+        """
+        Parses ejudge-execute's output given as an iterable of lines, such as its stdout pipe.
+        """
+
         self.verdict = None
         self.cpu_time = self.real_time = self.vm_size = 0
-        for line in binary_str.splitlines():
-            key, _, value = line.partition(b": ")
+        for line in lines:
+            key, _, value = line.rstrip(b"\r\n").partition(b": ")
             if key == b"Status":
                 if value not in { b"OK", b"TL", b"ML", b"RT", b"SV", b"SE" }:
                     raise ValueError("ejudge-execute returned unknown Status: %s" % value)
@@ -0,0 +1,62 @@
+import json
+import os
+import tempfile
+import threading
+
+
+class TestHistory:
+    """
+    Per-problem statistics of how often each test fails and how long it runs, stored as JSON
+    files. Losing an update to a concurrent tester is harmless, so files are simply replaced.
+    """
+
+    _lock = threading.Lock()
+
+    def __init__(self, path):
+        self._path = path
+        path.mkdir(parents=True, exist_ok=True)
+
+    @classmethod
+    def from_config(cls, cnf):
+        if cnf["behaviour"].get("test_order") != "fail_fast" or cnf["dirs"].get("cache") is None:
+            return None
+        return cls(cnf["dirs"]["cache"] / "history")
+
+    def _load(self, problem_id) -> { str: [int, int, int] }:
+        try:
+            with (self._path / ("%d.json" % problem_id)).open() as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return { }
+
+    def order(self, problem_id, tests):
+        """
+        Sorts the tests so that the ones that fail often and run fast come first.
+        """
+
+        stats = self._load(problem_id)
+
+        def priority(test):
+            runs, failures, total_time = stats.get(str(test.number), (0, 0, 0))
+            # Tests never seen before are assumed to fail half of the time.
+            failure_rate = (failures + 1) / (runs + 2)
+            average_time = (total_time + 1) / (runs + 1) # ms
+            return -failure_rate / average_time, test.number
+
+        return sorted(tests, key=priority)
+
+    def record(self, problem_id, outcomes: { int: (bool, int) }):
+        """
+        Takes {test number: (failed, time in ms)}.
+        """
+
+        with self._lock:
+            stats = self._load(problem_id)
+            for test_number, (failed, used_time) in outcomes.items():
+                runs, failures, total_time = stats.get(str(test_number), (0, 0, 0))
+                stats[str(test_number)] = (runs + 1, failures + failed, total_time + used_time)
+
+            fd, tmp_name = tempfile.mkstemp(dir=str(self._path), prefix=".")
+            with os.fdopen(fd, "w") as f:
+                json.dump(stats, f)
+            os.replace(tmp_name, str(self._path / ("%d.json" % problem_id)))
@@ -0,0 +1,152 @@
+"""
+Prometheus-style metrics of the tester, shared by all workers of the process.
+"""
+
+import contextlib
+import http.server
+import os
+import tempfile
+import threading
+import time
+
+
+BUCKETS = (.001, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 300) # sec
+
+_lock = threading.Lock()
+_metrics = [ ]
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (key, str(value)
+        .replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')) for key, value in labels)
+
+
+class Counter:
+    def __init__(self, name, description):
+        self.name = name
+        self.description = description
+        self._values = { }
+        _metrics.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with _lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        yield "# HELP %s %s" % (self.name, self.description)
+        yield "# TYPE %s counter" % self.name
+        for labels, value in self._values.items():
+            yield "%s%s %s" % (self.name, _format_labels(labels), value)
+
+
+class Histogram:
+    def __init__(self, name, description, buckets=BUCKETS):
+        self.name = name
+        self.description = description
+        self._buckets = buckets
+        self._values = { } # labels -> [count per bucket..., count, sum]
+        _metrics.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with _lock:
+            values = self._values.get(key)
+            if values is None:
+                values = self._values[key] = [0] * (len(self._buckets) + 1) + [0.]
+            for i, bound in enumerate(self._buckets):
+                if value <= bound:
+                    values[i] += 1
+            values[-2] += 1
+            values[-1] += value
+
+    def render(self):
+        yield "# HELP %s %s" % (self.name, self.description)
+        yield "# TYPE %s histogram" % self.name
+        for labels, values in self._values.items():
+            for bound, count in zip(self._buckets + ("+Inf", ), values):
+                yield "%s_bucket%s %d" % (
+                    self.name, _format_labels(labels + (("le", bound), )), count)
+            yield "%s_count%s %d" % (self.name, _format_labels(labels), values[-2])
+            yield "%s_sum%s %f" % (self.name, _format_labels(labels), values[-1])
+
+
+stage_duration = Histogram(
+    "lerna_tester_stage_duration_seconds",
+    "Time spent in each stage: acquire, compile, fetch, run, check, db, idle.",
+)
+attempts = Counter("lerna_tester_attempts_total", "Number of attempts taken for testing.")
+
+
+@contextlib.contextmanager
+def timed(stage, **labels):
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        stage_duration.observe(time.perf_counter() - start_time, stage=stage, **labels)
+
+
+def render() -> str:
+    with _lock:
+        return "".join(line + "\n" for metric in _metrics for line in metric.render())
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class Exporter:
+    """
+    Serves the metrics over HTTP and/or periodically writes them to a file, as configured.
+    """
+
+    def __init__(self, cnf):
+        cnf = cnf or { }
+        self._server = None
+        self._file = cnf.get("file") and os.path.abspath(cnf["file"])
+        self._interval = cnf.get("interval", 15)
+        self._stopped = threading.Event()
+        self._threads = [ ]
+        if cnf.get("port"):
+            self._server = http.server.HTTPServer(
+                (cnf.get("address", "127.0.0.1"), cnf["port"]), _Handler)
+            self._threads.append(threading.Thread(target=self._server.serve_forever, daemon=True))
+        if self._file:
+            self._threads.append(threading.Thread(target=self._write_periodically, daemon=True))
+        for thread in self._threads:
+            thread.start()
+
+    def _write(self):
+        fd, tmp_name = tempfile.mkstemp(dir=os.path.dirname(self._file), prefix=".")
+        with os.fdopen(fd, "w") as f:
+            f.write(render())
+        os.replace(tmp_name, self._file)
+
+    def _write_periodically(self):
+        while not self._stopped.wait(self._interval):
+            self._write()
+
+    def stop(self):
+        self._stopped.set()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+        for thread in self._threads:
+            thread.join()
+        if self._file:
+            self._write()
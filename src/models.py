@@ -16,5 +16,17 @@ ProblemInContest = collections.namedtuple("ProblemInContest",
 Compiler = collections.namedtuple("Compiler",
     ["name", "codename", "runner_codename"])
 
-Attempt = collections.namedtuple("Attempt",
-    ["id", "pic", "user", "source", "compiler"])
+class Attempt:
+    """
+    The rest of the fields are shared by the attempts of the same problem, user and compiler.
+    `source` is None until loaded, so that queued attempts take little memory.
+    """
+
+    __slots__ = ("id", "pic", "user", "source", "compiler")
+
+    def __init__(self, id, pic, user, source, compiler):
+        self.id = id
+        self.pic = pic
+        self.user = user
+        self.source = source
+        self.compiler = compiler
@@ -0,0 +1,192 @@
+"""
+The built-in runner, used instead of an ejudge-execute-compatible one for the runners listed in
+behaviour.native_runners. It starts the solution through `sh`, which applies the rlimits, moves
+itself to a cgroup v2 in behaviour.native_cgroup and execs the solution, so that no Python code
+runs between fork and exec. Time is measured with wait4. Memory is taken from memory.peak: the
+solution's ru_maxrss would include the tester's own memory, which is inherited across exec.
+"""
+
+import itertools
+import os
+import resource
+import signal
+import subprocess
+import threading
+import time
+
+from verdict import Verdict
+
+
+_counter = itertools.count()
+
+
+class Result:
+    """
+    Has the same fields as ejudge.Protocol.
+    """
+
+    def __init__(self, verdict, cpu_time, real_time, vm_size):
+        self.verdict = verdict
+        self.cpu_time = cpu_time   # ms
+        self.real_time = real_time # ms
+        self.vm_size = vm_size     # bytes
+
+
+def real_time_limit(time_limit):
+    """
+    Takes the time limit in ms. Solutions that run longer than this in real time are killed.
+    """
+
+    return 2 * time_limit + 1000
+
+
+# Runs as `sh -c _WRAPPER sh <cgroup.procs> <CPU limit> <stack limit> <stdout> <command>...`
+# with a pipe as its stdout, to which it reports that everything has been applied. Only fds
+# 0-9 can be redirected in dash, so the pipe cannot be passed as an arbitrary fd.
+_WRAPPER = """
+echo $$ > "$1" &&
+ulimit -S -c 0 &&
+ulimit -S -t "$2" &&
+ulimit -S -s "$3" &&
+exec 3> "$4" &&
+echo &&
+shift 4 &&
+exec "$@" >&3 3>&-
+"""
+
+
+class _Cgroup:
+    def __init__(self, root, memory_limit):
+        self.path = os.path.join(root, "run.%d.%d" % (os.getpid(), next(_counter)))
+        os.mkdir(self.path)
+        if not os.path.exists(os.path.join(self.path, "memory.peak")):
+            os.rmdir(self.path)
+            raise OSError("memory.peak is not supported (requires Linux 5.19)")
+        self._write("memory.max", memory_limit)
+        try:
+            self._write("memory.swap.max", 0)
+        except FileNotFoundError:
+            pass # No swap accounting.
+
+    def _write(self, name, value):
+        with open(os.path.join(self.path, name), "w") as f:
+            f.write(str(value))
+
+    def _read(self, name):
+        with open(os.path.join(self.path, name)) as f:
+            return f.read()
+
+    def peak(self):
+        return int(self._read("memory.peak"))
+
+    def oom_killed(self):
+        for line in self._read("memory.events").splitlines():
+            key, _, value = line.partition(" ")
+            if key == "oom_kill":
+                return int(value) > 0
+        return False
+
+    def close(self):
+        # Whatever the solution has left running.
+        try:
+            self._write("cgroup.kill", 1)
+        except FileNotFoundError:
+            pass # Before Linux 5.14.
+        for _ in range(100):
+            try:
+                os.rmdir(self.path)
+                return
+            except OSError:
+                time.sleep(.01)
+        os.rmdir(self.path)
+
+
+def _soft_limit(limit, value) -> int:
+    # The solution inherits the tester's hard limits, which the soft ones cannot exceed.
+    _, hard = resource.getrlimit(limit)
+    if hard != resource.RLIM_INFINITY:
+        value = min(value, hard)
+    return value
+
+
+def run(spec, data, cwd, stdin, stdout, stderr, time_limit, memory_limit, cgroup_root):
+    """
+    Takes the runner's specification from the config, the compiled solution, the same
+    arguments as the runners do: file names relative to `cwd`, the time limit in ms and
+    the memory limit in MB (as strings or ints), and the cgroup to create child cgroups in.
+    Returns a Result.
+    """
+
+    time_limit = int(time_limit)
+    memory_limit = int(memory_limit) << 20
+    binary = cwd / spec["file"]
+    with open(str(binary), "wb") as f:
+        f.write(data)
+    binary.chmod(0o755)
+
+    killed = threading.Event()
+
+    def kill():
+        killed.set()
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+    cgroup = _Cgroup(cgroup_root, memory_limit)
+    ready_fd, wrapper_fd = os.pipe()
+    try:
+        args = [
+            "/bin/sh", "-c", _WRAPPER, "sh",
+            os.path.join(cgroup.path, "cgroup.procs"),
+            str(_soft_limit(resource.RLIMIT_CPU, time_limit // 1000 + 1)), # sec
+            str(_soft_limit(resource.RLIMIT_STACK, memory_limit) >> 10), # KB
+            str(cwd / stdout),
+        ] + list(spec["command"])
+        with open(str(cwd / stdin), "rb") as stdin_file, \
+             open(str(cwd / stderr), "wb") as stderr_file:
+            start_time = time.monotonic()
+            # No preexec_fn: Python code is not safe to run in a fork of a threaded process.
+            proc = subprocess.Popen(
+                args,
+                stdin=stdin_file,
+                stdout=wrapper_fd,
+                stderr=stderr_file,
+                cwd=str(cwd),
+                start_new_session=True,
+            )
+        os.close(wrapper_fd)
+        wrapper_fd = None
+        timer = threading.Timer(real_time_limit(time_limit) / 1000, kill)
+        timer.start()
+        try:
+            _, status, usage = os.wait4(proc.pid, 0)
+        finally:
+            timer.cancel()
+        real_time = int((time.monotonic() - start_time) * 1000 + .5)
+        # Let Popen know that the process has been reaped.
+        proc.returncode = os.waitstatus_to_exitcode(status)
+
+        if not os.read(ready_fd, 1):
+            raise OSError("Cannot apply the limits, see %s" % stderr)
+
+        cpu_time = int((usage.ru_utime + usage.ru_stime) * 1000 + .5)
+        vm_size = cgroup.peak()
+        oom_killed = cgroup.oom_killed()
+    finally:
+        os.close(ready_fd)
+        if wrapper_fd is not None:
+            os.close(wrapper_fd)
+        cgroup.close()
+
+    if cpu_time > time_limit:
+        verdict = Verdict.TL
+    elif killed.is_set():
+        verdict = Verdict.IL
+    elif oom_killed or vm_size > memory_limit:
+        verdict = Verdict.ML
+    elif proc.returncode != 0:
+        verdict = Verdict.RT
+    else:
+        verdict = Verdict.OK
+    return Result(verdict, cpu_time, real_time, vm_size)
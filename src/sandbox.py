@@ -0,0 +1,123 @@
+import itertools
+import os
+import queue
+import shutil
+import subprocess
+import threading
+
+
+def clean_dir(path):
+    """
+    Removes every file and directory at the given path.
+    """
+
+    for entry in path.iterdir():
+        if entry.is_file() or entry.is_symlink():
+            entry.unlink()
+        else:
+            shutil.rmtree(str(entry))
+
+
+class Sandbox:
+    """
+    The directory solutions are compiled and run in. `reset` empties it before each attempt
+    by removing whatever the previous solution left behind.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def reset(self):
+        clean_dir(self.path)
+
+    def close(self):
+        pass
+
+
+class RotatingSandbox(Sandbox):
+    """
+    Resets the sandbox by renaming it and creating an empty one instead. Old sandboxes are
+    removed in a background thread.
+    """
+
+    def __init__(self, root):
+        super().__init__(root / "sandbox")
+        self._root = root
+        self._counter = itertools.count()
+        self._trash = queue.Queue()
+        self._cleaner = threading.Thread(target=self._clean, daemon=True)
+        self._cleaner.start()
+        # Left over by a previous run.
+        for entry in root.glob(".trash.*"):
+            self._trash.put(entry)
+        if self.path.exists():
+            self.reset()
+        else:
+            self._make()
+
+    def _make(self):
+        self.path.mkdir()
+        self.path.chmod(0o777)
+
+    def _clean(self):
+        while True:
+            path = self._trash.get()
+            if path is None:
+                break
+            shutil.rmtree(str(path), ignore_errors=True)
+
+    def reset(self):
+        while True:
+            trash = self._root / (".trash.%d.%d" % (os.getpid(), next(self._counter)))
+            if not trash.exists():
+                break
+        self.path.rename(trash)
+        self._trash.put(trash)
+        self._make()
+
+    def close(self):
+        self._trash.put(None)
+        self._cleaner.join()
+
+
+class TmpfsSandbox(Sandbox):
+    """
+    Mounts a fresh tmpfs for each attempt, so that nothing has to be removed and the files
+    of the solution are kept in memory. Requires the privilege to mount file systems.
+    """
+
+    def __init__(self, root, size):
+        super().__init__(root / "sandbox")
+        self._options = "size=%s,mode=0777" % size
+        self.path.mkdir(exist_ok=True)
+        self.reset()
+
+    def _unmount(self):
+        if os.path.ismount(str(self.path)):
+            # Lazily, in case a process of the solution has survived.
+            subprocess.run(["umount", "--lazy", str(self.path)], check=True)
+
+    def reset(self):
+        self._unmount()
+        subprocess.run(
+            ["mount", "-t", "tmpfs", "-o", self._options, "tmpfs", str(self.path)], check=True)
+
+    def close(self):
+        self._unmount()
+
+
+def from_config(cnf, root) -> Sandbox:
+    """
+    Creates a sandbox of the configured kind in `root`, which becomes the sandbox itself
+    unless the kind needs a separate directory.
+    """
+
+    kind = cnf["behaviour"].get("sandbox", "clean")
+    if kind == "clean":
+        return Sandbox(root)
+    elif kind == "rotate":
+        return RotatingSandbox(root)
+    elif kind == "tmpfs":
+        return TmpfsSandbox(root, cnf["behaviour"].get("sandbox_size", "256m"))
+    else:
+        raise ValueError("Unknown sandbox kind: %s" % kind)
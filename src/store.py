@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+
+"""
+A store of problems that testers fetch on demand instead of reading them from a synced copy.
+
+Each problem is a content-addressed bundle: `bundles/<SHA-256>.tar.gz` holds the contents of
+the problem's directory, and `<problem path>.version` holds the hash of its current bundle.
+The store can be a directory or anything serving it over HTTP(S).
+
+Usage:
+  ./src/store.py publish <problems-dir> <store-dir> [<path>...]
+
+Publishes the given problems (paths relative to <problems-dir>, every directory containing
+files by default) to the store. Unchanged problems keep their versions.
+"""
+
+import contextlib
+import docopt
+import fcntl
+import gzip
+import hashlib
+import io
+import os
+import pathlib
+import shutil
+import tarfile
+import tempfile
+import threading
+import time
+import urllib.parse
+import urllib.request
+
+
+class ProblemStore:
+    """
+    Fetches problems from the store and keeps them extracted in a local cache of bounded size.
+    The least recently used versions are evicted, unless they have been used within a minute or
+    are pinned by a tester on this machine.
+    """
+
+    _IN_USE = 60 # sec
+
+    def __init__(self, url, path, max_size, version_ttl, prefetch_interval=60):
+        self._url = url
+        self._path = path
+        self._max_size = max_size
+        self._version_ttl = version_ttl
+        self._versions = { } # problem path -> (version, time it has been checked at)
+        self._lock = threading.Lock()
+        self._prefetcher = None
+        self.prefetch_interval = prefetch_interval
+        path.mkdir(parents=True, exist_ok=True)
+
+    @classmethod
+    def from_config(cls, cnf):
+        store_cnf = cnf.get("problem_store") or { }
+        if not store_cnf.get("url") or cnf["dirs"].get("cache") is None:
+            return None
+        return cls(
+            store_cnf["url"],
+            cnf["dirs"]["cache"] / "problems",
+            store_cnf.get("cache_size", 10 * 2 ** 30),
+            store_cnf.get("version_ttl", 10),
+            store_cnf.get("prefetch_interval", 60),
+        )
+
+    def _open(self, name):
+        if self._url.startswith(("http://", "https://")):
+            return urllib.request.urlopen(
+                self._url.rstrip("/") + "/" + urllib.parse.quote(name), timeout=60)
+        return open(os.path.join(self._url, name), "rb")
+
+    def _version(self, problem_path) -> str:
+        with self._lock:
+            cached = self._versions.get(problem_path)
+        if cached is not None and time.monotonic() - cached[1] < self._version_ttl:
+            return cached[0]
+        with self._open(problem_path + ".version") as f:
+            version = f.read().decode().strip()
+        with self._lock:
+            self._versions[problem_path] = (version, time.monotonic())
+        return version
+
+    def _download(self, version):
+        h = hashlib.sha256()
+        with tempfile.TemporaryFile() as bundle:
+            with self._open("bundles/%s.tar.gz" % version) as f:
+                for chunk in iter(lambda: f.read(2 ** 20), b""):
+                    h.update(chunk)
+                    bundle.write(chunk)
+            if h.hexdigest() != version:
+                raise ValueError("Bundle %s is corrupted" % version)
+
+            bundle.seek(0)
+            tmp_dir = tempfile.mkdtemp(dir=str(self._path), prefix=".")
+            try:
+                size = 0
+                with tarfile.open(fileobj=bundle, mode="r:gz") as tar:
+                    for member in tar:
+                        size += member.size
+                    if hasattr(tarfile, "data_filter"):
+                        tar.extractall(tmp_dir, filter="data")
+                    else:
+                        tar.extractall(tmp_dir)
+                os.chmod(tmp_dir, 0o755)
+                (self._path / (version + ".size")).write_text(str(size))
+                try:
+                    os.rename(tmp_dir, str(self._path / version))
+                except OSError:
+                    pass # Fetched by another tester meanwhile.
+            finally:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def fetch(self, problem_path) -> pathlib.Path:
+        """
+        Returns the local directory with the current version of the problem.
+        """
+
+        with self.pinned(problem_path) as path:
+            return path
+
+    def _lock_file(self, version):
+        return os.open(str(self._path / (version + ".lock")), os.O_RDWR | os.O_CREAT, 0o644)
+
+    @contextlib.contextmanager
+    def pinned(self, problem_path):
+        """
+        Same as `fetch`, but the version cannot be evicted until the block is exited.
+        """
+
+        version = self._version(problem_path)
+        while True:
+            fd = self._lock_file(version)
+            fcntl.flock(fd, fcntl.LOCK_SH)
+            # The lock file may have been removed along with the version meanwhile.
+            try:
+                if os.stat(str(self._path / (version + ".lock"))).st_ino == os.fstat(fd).st_ino:
+                    break
+            except FileNotFoundError:
+                pass
+            os.close(fd)
+        try:
+            path = self._path / version
+            if not path.is_dir():
+                self._download(version)
+                self._evict(version)
+            os.utime(str(path))
+            yield path
+        finally:
+            os.close(fd)
+
+    def prefetch(self, problem_paths):
+        """
+        Fetches the current versions of the problems in the background, unless the previous
+        prefetch is still running.
+        """
+
+        if self._prefetcher is not None and self._prefetcher.is_alive():
+            return
+
+        def fetch_all():
+            for problem_path in sorted(problem_paths):
+                try:
+                    self.fetch(problem_path)
+                except Exception as e:
+                    print("Cannot prefetch %s: %s" % (problem_path, e), flush=True)
+
+        self._prefetcher = threading.Thread(target=fetch_all, daemon=True)
+        self._prefetcher.start()
+
+    def _evict(self, keep):
+        entries = [ ]
+        total_size = 0
+        for size_file in self._path.glob("*.size"):
+            version = size_file.name[:-len(".size")]
+            try:
+                size = int(size_file.read_text())
+                used_at = os.stat(str(self._path / version)).st_mtime
+            except (OSError, ValueError):
+                continue
+            total_size += size
+            entries.append((used_at, size, version))
+
+        entries.sort()
+        now = time.time()
+        for used_at, size, version in entries:
+            if total_size <= self._max_size or now - used_at < self._IN_USE:
+                break
+            if version == keep:
+                continue
+            fd = self._lock_file(version)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)
+                continue # Pinned.
+            try:
+                shutil.rmtree(str(self._path / version), ignore_errors=True)
+                for suffix in (".size", ".lock"):
+                    with contextlib.suppress(FileNotFoundError): # Evicted by another tester.
+                        (self._path / (version + suffix)).unlink()
+            finally:
+                os.close(fd)
+            total_size -= size
+
+
+def make_bundle(problem_dir) -> bytes:
+    """
+    Packs the directory deterministically, so that the same contents give the same hash.
+    """
+
+    buf = io.BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode="wb", mtime=0) as gz:
+        with tarfile.open(fileobj=gz, mode="w", format=tarfile.PAX_FORMAT) as tar:
+            for path in sorted(problem_dir.rglob("*")):
+                info = tar.gettarinfo(str(path), str(path.relative_to(problem_dir)))
+                info.mtime = 0
+                info.uid = info.gid = 0
+                info.uname = info.gname = ""
+                if path.is_file():
+                    with path.open("rb") as f:
+                        tar.addfile(info, f)
+                else:
+                    tar.addfile(info)
+    return buf.getvalue()
+
+
+def write_atomically(path, data):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_name = tempfile.mkstemp(dir=str(path.parent), prefix=".")
+    with os.fdopen(fd, "wb") as f:
+        f.write(data)
+    os.chmod(tmp_name, 0o644)
+    os.replace(tmp_name, str(path))
+
+
+def publish(problems_dir, store_dir, problem_paths):
+    for problem_path in problem_paths:
+        bundle = make_bundle(problems_dir / problem_path)
+        version = hashlib.sha256(bundle).hexdigest()
+        bundle_path = store_dir / "bundles" / (version + ".tar.gz")
+        if not bundle_path.exists():
+            write_atomically(bundle_path, bundle)
+        # After the bundle, so that testers never see a version they cannot fetch.
+        write_atomically(store_dir / (problem_path + ".version"), version.encode() + b"\n")
+        print(problem_path, version)
+
+
+def main():
+    args = docopt.docopt(__doc__)
+    problems_dir = pathlib.Path(args["<problems-dir>"]).resolve()
+    problem_paths = args["<path>"] or sorted(
+        str(path.relative_to(problems_dir)) for path in problems_dir.rglob("*")
+        if path.is_dir() and any(entry.is_file() for entry in path.iterdir())
+    )
+    publish(problems_dir, pathlib.Path(args["<store-dir>"]), problem_paths)
+
+
+if __name__ == "__main__":
+    main()
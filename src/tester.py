@@ -1,20 +1,43 @@
+import collections
+import concurrent.futures
+import contextlib
 import datetime
-import itertools
+import hashlib
 import logging
 import os.path
-import pathlib
 import shlex
 import shutil
 import subprocess
+import tarfile
+import tempfile
 import textwrap
+import threading
 import time
 
+import cache
+import calibration
+import checkers
+import comparators
 import database
 import ejudge
+import history
+import metrics
+import native
+import sandbox
+import store
+import testset
 from   verdict import Verdict
 
 
 needs_restarting = False
+EJUDGE_LOG_LINES = 100
+# (checker command, problem directory) -> (args, path to the checker, its mtime).
+_located_checkers = { }
+# Connections kept across restarts: tester name -> (connection parameters, connection).
+_connections = { }
+# The problems are prefetched by one of the workers of the process at a time.
+_prefetch_lock = threading.Lock()
+_next_prefetch_time = 0
 
 
 class RecoverableError(Exception):
@@ -23,41 +46,75 @@ class RecoverableError(Exception):
     """
 
 
-def clean_dir(path):
-    """
-    Removes every file and directory at the given path.
-    """
+def compile_source(cnf, source, compiler_codename, cwd, compilation_cache=None) -> (bytes, bytes):
+    compiler = cnf["exec"]["compilers"][compiler_codename]
+    if isinstance(source, str):
+        source = source.encode()
+    if compilation_cache is not None:
+        key = compilation_cache.key(compiler_codename, compiler, source)
+        cached = compilation_cache.get(key)
+        if cached is not None:
+            print("Using cached compilation result", flush=True)
+            return cached
 
-    for entry in path.iterdir():
-        if entry.is_file() or entry.is_symlink():
-            entry.unlink()
-        else:
-            shutil.rmtree(str(entry))
+    proc = subprocess.run(
+        [compiler],
+        input=source,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        cwd=str(cwd),
+    )
+    result = proc.stdout if proc.returncode == 0 else None, proc.stderr
+    if compilation_cache is not None:
+        compilation_cache.put(key, *result)
+    return result
 
 
-def iterpattern(pattern, start=0):
+def compile_checker(cnf, path, compiler_codename, compilation_cache=None) -> str:
     """
-    Yields index-annotated file names that match the given pattern.
+    Compiles the checker's source once and returns the path to the resulting executable.
     """
 
-    for i in itertools.count(start):
-        file_name = pattern % i
-        if not os.path.isfile(file_name):
-            break
-        yield i, file_name
+    if cnf["dirs"]["cache"] is None:
+        raise RecoverableError("Cannot compile the checker: no cache directory")
 
+    compiler = cnf["exec"]["compilers"].get(compiler_codename)
+    if compiler is None:
+        raise RecoverableError("Cannot compile the checker: no compiler %s" % compiler_codename)
 
-def compile_source(cnf, source, compiler_codename) -> (bytes, bytes):
-    proc = subprocess.run(
-        [cnf["exec"]["compilers"][compiler_codename]],
-        input=source.encode(),
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-    )
-    return proc.stdout if proc.returncode == 0 else None, proc.stderr
+    with open(path, "rb") as f:
+        source = f.read()
+    checkers_dir = cnf["dirs"]["cache"] / "checkers"
+    binary_path = checkers_dir / cache.CompilationCache.key(compiler_codename, compiler, source)
+    if binary_path.is_file():
+        return str(binary_path)
 
+    print("Compiling the checker...", flush=True)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        data, errors = compile_source(cnf, source, compiler_codename, tmp_dir, compilation_cache)
+    if data is None:
+        raise RecoverableError("Checker compilation error")
+
+    checkers_dir.mkdir(exist_ok=True)
+    fd, tmp_name = tempfile.mkstemp(dir=str(checkers_dir), prefix=".")
+    with os.fdopen(fd, "wb") as f:
+        f.write(data)
+    os.chmod(tmp_name, 0o755)
+    os.replace(tmp_name, str(binary_path))
+    return str(binary_path)
+
+
+def locate_checker(cnf, checker_cmd, probable_path, compilation_cache=None) -> [str]:
+    key = (checker_cmd, str(probable_path))
+    cached = _located_checkers.get(key)
+    if cached is not None:
+        args, path, mtime_ns = cached
+        try:
+            if os.stat(path).st_mtime_ns == mtime_ns:
+                return list(args)
+        except FileNotFoundError:
+            pass
 
-def locate_checker(cnf, checker_cmd, probable_path) -> [str]:
     args = shlex.split(checker_cmd)
     if not args:
         raise RecoverableError("Checker is empty")
@@ -68,124 +125,515 @@ def locate_checker(cnf, checker_cmd, probable_path) -> [str]:
     if not os.path.isfile(args[0]):
         raise RecoverableError("Checker is not found")
 
-    return args
+    path = args[0]
+    mtime_ns = os.stat(path).st_mtime_ns
+    compiler_codename = cnf["behaviour"].get("checker_compilers", { }).get(
+        os.path.splitext(path)[1])
+    if compiler_codename is not None:
+        args[0] = compile_checker(cnf, path, compiler_codename, compilation_cache)
 
+    _located_checkers[key] = (args, path, mtime_ns)
+    return list(args)
 
-def execute_program(cnf, args, data):
-    proc = subprocess.run(args, input=data, stdout=subprocess.PIPE)
-    with open(cnf["files"]["ejudge_log"], "wb") as f:
-        f.write(proc.stdout)
-    try:
-        return ejudge.Protocol(proc.stdout)
-    except ValueError as e:
-        raise RecoverableError(*e.args)
 
+def execute_program(cnf, args, data, cwd):
+    # Only the tail of the protocol is kept for the log, which is written on system errors only.
+    log = collections.deque(maxlen=EJUDGE_LOG_LINES)
+
+    def read_lines(stream):
+        for line in stream:
+            log.append(line)
+            yield line
+
+    error = None
+    with subprocess.Popen(
+        args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, cwd=str(cwd),
+    ) as proc:
+        # The runner consumes the whole binary before running it and writing the protocol.
+        try:
+            proc.stdin.write(data)
+        except BrokenPipeError:
+            pass # The runner has exited, the protocol tells why.
+        try:
+            proc.stdin.close()
+        except BrokenPipeError:
+            pass
+        lines = read_lines(proc.stdout)
+        try:
+            protocol = ejudge.Protocol(lines)
+        except ValueError as e:
+            error = e
+        for _ in lines:
+            pass
+
+    if error is not None or protocol.verdict is Verdict.SE or cnf["behaviour"].get("keep_logs"):
+        with open(str(cwd / cnf["files"]["ejudge_log"]), "wb") as f:
+            f.writelines(log)
+    if error is not None:
+        raise RecoverableError(*error.args)
+    return protocol
+
+
+def check_output(
+    args, input_file, output_file, answer_file, cwd, server_key=None, max_comment_size=None,
+) -> (Verdict, bytes):
+    if server_key is not None:
+        try:
+            returncode, comment = checkers.servers.check(
+                server_key, args, cwd, input_file, output_file, answer_file, max_comment_size)
+        except checkers.ProtocolError as e:
+            print(e.args[0], "- falling back to a separate process", flush=True)
+        else:
+            return Verdict.from_testlib_returncode(returncode), comment
 
-def check_output(args, input_file, output_file, answer_file, cwd) -> (Verdict, bytes):
     extra_args = [input_file, output_file, answer_file] # Assume the checker is testlib-compatible.
     # Command line may look like "/usr/bin/java check", so we need to chdir.
-    proc = subprocess.run(args + extra_args, stderr=subprocess.PIPE, cwd=cwd)
-    return Verdict.from_testlib_returncode(proc.returncode), proc.stderr
+    with subprocess.Popen(args + extra_args, stderr=subprocess.PIPE, cwd=cwd) as proc:
+        comment = proc.stderr.read(-1 if max_comment_size is None else max_comment_size)
+        # Discard the rest, so that the checker does not block on a full pipe.
+        while proc.stderr.read(2 ** 16):
+            pass
+    return Verdict.from_testlib_returncode(proc.returncode), comment
+
+
+# Everything `run_test` needs to know about the attempt being tested.
+Job = collections.namedtuple("Job",
+    ["cnf", "problem", "data", "runner_args", "comparator", "checker_args", "checker_server_key",
+     "labels", "tests_path", "native_runner", "time_multiplier"])
 
 
-def run_tests(db, cnf, cwd, attempt, logger_info, data):
+def run_test(job, cwd, test):
+    """
+    Runs the program on a single test inside `cwd` and checks its output.
+    Returns the runner's protocol and the (undecorated) checker comment.
+    """
+
+    cnf, problem = job.cnf, job.problem
+    testset.provide(
+        test, str(cwd / cnf["files"]["stdin"]), cnf["behaviour"].get("link_tests", False))
+    with metrics.timed("run", **job.labels):
+        if job.native_runner is None:
+            protocol = execute_program(cnf, job.runner_args, job.data, cwd)
+        else:
+            try:
+                protocol = native.run(
+                    job.native_runner, job.data, cwd, *job.runner_args[1:],
+                    cgroup_root=cnf["behaviour"]["native_cgroup"],
+                )
+            except OSError as e:
+                raise RecoverableError("Cannot run the solution: %s" % e)
+    protocol.cpu_time = int(protocol.cpu_time * job.time_multiplier + .5)
+    protocol.real_time = int(protocol.real_time * job.time_multiplier + .5)
+    checker_comment = ""
+    if protocol.verdict is Verdict.TL:
+        # ejudge-execute cannot tell TL apart from IL.
+        if protocol.cpu_time < problem.time_limit and protocol.real_time >= problem.time_limit:
+            protocol.verdict = Verdict.IL
+    elif protocol.verdict is Verdict.OK:
+        tests_path = job.tests_path
+        output_file = str(cwd / cnf["files"]["stdout"])
+        answer_file = problem.mask_out % test.number if problem.mask_out else os.devnull
+        with metrics.timed("check", **job.labels):
+            if job.comparator is not None:
+                protocol.verdict, checker_comment = job.comparator(
+                    output_file, os.path.join(str(tests_path), answer_file))
+            else:
+                protocol.verdict, checker_comment = check_output(
+                    job.checker_args,
+                    test.path,
+                    output_file,
+                    answer_file,
+                    cwd=str(tests_path),
+                    server_key=job.checker_server_key,
+                    # Enough for the comment to be truncated the same way, whatever the encoding.
+                    max_comment_size=4 * (cnf["behaviour"]["checker_comment_max_len"] + 1) + 3,
+                )
+        checker_comment = checker_comment.decode(errors="replace")
+    return protocol, checker_comment
+
+
+# The outcome of a test reused from an earlier testing of the attempt.
+CachedProtocol = collections.namedtuple("CachedProtocol", ["verdict", "cpu_time", "vm_size"])
+
+
+def normalize_source(source) -> bytes:
+    """
+    Drops trailing whitespace and unifies line endings, which hardly ever change the meaning of
+    a program, so that resubmits and copies of the same solution are recognized.
+    """
+
+    source = source.encode() if isinstance(source, str) else source
+    return b"\n".join(line.rstrip() for line in source.splitlines()).rstrip()
+
+
+def _checker_digest(attempt, checker, tests_path):
+    """
+    Returns None if the checker's outcome may depend on files that cannot be told from its
+    command, like the class a JVM loads or a directory.
+    """
+
+    if isinstance(checker, str):
+        return checker
+    # Not the path of the checker, which changes with the version of a fetched problem.
+    parts = [testset.digest(checker[0])]
+    named_files = False
+    for arg in checker[1:]:
+        # Checkers run in the problem's directory.
+        path = os.path.join(str(tests_path), arg)
+        if os.path.isfile(path):
+            parts.append(testset.digest(path))
+            named_files = True
+        elif os.path.exists(path):
+            return None
+        else:
+            parts.append(arg)
+    # A command given by an absolute path may be an interpreter, e.g. `/usr/bin/java check`.
+    if os.path.isabs(shlex.split(attempt.pic.problem.checker)[0]) and not named_files:
+        return None
+    return " ".join(parts)
+
+
+def _hash_setup(cnf, attempt, source, runner_args, time_multiplier, checker, tests_path):
+    checker = _checker_digest(attempt, checker, tests_path)
+    if checker is None:
+        return None
+    compiler = cnf["exec"]["compilers"][attempt.compiler.codename]
+    native_runner = cnf["behaviour"].get("native_runners", { }).get(
+        attempt.compiler.runner_codename)
+    source = source.encode() if isinstance(source, str) else source
+    h = hashlib.sha256()
+    for part in (
+        cache.CompilationCache.key(attempt.compiler.codename, compiler, source),
+        testset.digest(runner_args[0]) if native_runner is None else repr(native_runner),
+        " ".join(runner_args[1:]),
+        str(time_multiplier),
+        checker,
+    ):
+        h.update(part.encode() + b"\0")
+    return h
+
+
+def _test_digest(problem, tests_path, test) -> bytes:
+    digest = testset.digest(test.path)
+    if problem.mask_out:
+        digest += testset.digest(str(tests_path / (problem.mask_out % test.number)))
+    return digest.encode()
+
+
+def fingerprint_tests(
+    cnf, attempt, runner_args, time_multiplier, checker, tests_path, tests,
+) -> { int: str }:
+    """
+    Fingerprints everything the outcome of each test depends on: the source and the compiler,
+    the runner and the limits, the checker (a command or a built-in comparator), the input and
+    the answer. Returns an empty dict if the checker cannot be fingerprinted.
+    """
+
+    h = _hash_setup(
+        cnf, attempt, attempt.source, runner_args, time_multiplier, checker, tests_path)
+    fingerprints = { }
+    if h is None:
+        return fingerprints
+    for test in tests:
+        test_hash = h.copy()
+        test_hash.update(_test_digest(attempt.pic.problem, tests_path, test))
+        fingerprints[test.number] = test_hash.hexdigest()
+    return fingerprints
+
+
+def fingerprint_attempt(
+    cnf, attempt, runner_args, time_multiplier, checker, tests_path, tests,
+) -> str:
+    """
+    Fingerprints everything the result of the attempt depends on, like `fingerprint_tests`
+    does for each test, but with the source normalized. Returns None if the checker cannot be
+    fingerprinted.
+    """
+
+    h = _hash_setup(
+        cnf, attempt, normalize_source(attempt.source), runner_args, time_multiplier, checker,
+        tests_path,
+    )
+    if h is None:
+        return None
+    h.update(b"school\0" if attempt.pic.contest.is_school else b"acm\0")
+    for test in tests:
+        h.update(b"%d\0" % test.number + _test_digest(attempt.pic.problem, tests_path, test))
+    return h.hexdigest()
+
+
+def run_isolated_test(job, cwd, test):
+    """
+    Same as `run_test`, but uses a fresh subdirectory of `cwd`, which is removed afterwards.
+    The runner's log, if written, is kept in `cwd` with the test number appended to its name.
+    """
+
+    # Solutions of the other tests can write to `cwd`, so the name must not be predictable.
+    try:
+        test_cwd = cwd / os.path.basename(
+            tempfile.mkdtemp(prefix="test%d." % test.number, dir=str(cwd)))
+        test_cwd.chmod(0o777)
+    except OSError as e:
+        raise RecoverableError("Cannot create a directory for test %d: %s" % (test.number, e))
+    try:
+        return run_test(job, test_cwd, test)
+    except OSError as e:
+        raise RecoverableError("Cannot run test %d: %s" % (test.number, e))
+    finally:
+        ejudge_log = job.cnf["files"]["ejudge_log"]
+        try:
+            if (test_cwd / ejudge_log).exists():
+                (test_cwd / ejudge_log).replace(cwd / ("%s.%d" % (ejudge_log, test.number)))
+        except OSError:
+            pass # Whatever the solutions have put in the way; the log is not essential.
+        # The sandbox is emptied before the next attempt anyway.
+        shutil.rmtree(str(test_cwd), ignore_errors=True)
+
+
+@contextlib.contextmanager
+def problem_dir(cnf, problem, problem_store=None):
+    """
+    Yields the directory with the problem's tests and checker: the local copy fetched from
+    the store if there is one, which is kept until the block is exited, or the problem's
+    directory in dirs.problems.
+    """
+
+    if problem_store is None:
+        yield cnf["dirs"]["problems"] / problem.path
+        return
+    with contextlib.ExitStack() as stack:
+        try:
+            with metrics.timed("fetch", problem=problem.id):
+                tests_path = stack.enter_context(problem_store.pinned(problem.path))
+        except (OSError, ValueError, tarfile.TarError) as e:
+            raise RecoverableError("Cannot fetch the problem: %s" % e)
+        yield tests_path
+
+
+def run_tests(db, cnf, cwd, attempt, logger_info, data, labels, tests_path, compilation_cache=None):
     problem = attempt.pic.problem
     is_school = attempt.pic.contest.is_school
+    # Calibration may change it meanwhile; the whole attempt must be run and reported under one.
+    time_multiplier = cnf["behaviour"]["time_multiplier"]
+    native_runner = cnf["behaviour"].get("native_runners", { }).get(
+        attempt.compiler.runner_codename)
+    if native_runner is None:
+        runner = cnf["exec"]["runners"][attempt.compiler.runner_codename]
+    else:
+        runner = "native" # The rest of the arguments are passed to native.run.
     runner_args = [
-        cnf["exec"]["runners"][attempt.compiler.runner_codename],
+        runner,
         cnf["files"]["stdin"],
         cnf["files"]["stdout"],
         cnf["files"]["stderr"],
-        str(int(problem.time_limit / cnf["behaviour"]["time_multiplier"] + .5)),
+        str(int(problem.time_limit / time_multiplier + .5)),
         str(problem.memory_limit),
     ]
-    tests_path = cnf["dirs"]["problems"] / problem.path
-    checker_args = locate_checker(cnf, problem.checker, tests_path)
+    comparator_spec = cnf["behaviour"].get("builtin_checkers", { }).get(problem.checker)
+    checker_args = checker_server_key = None
+    if comparator_spec is not None:
+        comparator = comparators.get(comparator_spec)
+    else:
+        comparator = None
+        checker_args = locate_checker(cnf, problem.checker, tests_path, compilation_cache)
+        if problem.checker in cnf["behaviour"].get("checker_servers", ()):
+            checker_server_key = (
+                checker_args[0], os.stat(checker_args[0]).st_mtime_ns, str(tests_path))
+    job = Job(
+        cnf, problem, data, runner_args, comparator, checker_args, checker_server_key, labels,
+        tests_path, native_runner, time_multiplier,
+    )
     checker_comment_max_len = cnf["behaviour"]["checker_comment_max_len"]
     assert checker_comment_max_len >= 3
+    # Tests are independent of each other only if all of them are run anyway.
+    parallel_tests = cnf["behaviour"].get("parallel_tests", 1) if is_school else 1
+    test_history = history.TestHistory.from_config(cnf)
+    outcomes = { }
 
     max_time     = 1 # ms
     max_memory   = 125 # KB
     passed_tests = 0
 
-    print(tests_path, '*', sep=os.sep)
-    for test_number, test_file in iterpattern(str(tests_path / problem.mask_in), 1):
+    def report_progress(test_number, used_time=1, used_memory=125):
+        # Also takes the stats of the tests that have been run but not reported yet.
         print(problem.mask_in % test_number, flush=True)
+        db.report_progress(
+            attempt.id, "Testing... %d" % test_number,
+            max(max_time, used_time) / 1000, max(max_memory, used_memory),
+        )
+
+    tests = testset.index(str(tests_path / problem.mask_in))
+
+    # Attempts identical to an already tested one get its result without running the tests.
+    if cnf["behaviour"].get("memoize_results"):
+        attempt_fingerprint = fingerprint_attempt(
+            cnf, attempt, runner_args, time_multiplier, comparator_spec or checker_args,
+            tests_path, tests,
+        )
+        db.set_attempt_fingerprint(attempt_fingerprint)
+        memoized = attempt_fingerprint and db.find_memoized_result(attempt_fingerprint, attempt.id)
+        margin = cnf["behaviour"].get("memoize_reverify_margin")
+        if memoized is not None and (
+            # Results close to the time limit may differ when retested.
+            margin is None or float(memoized[2]) * 1000 < (1 - margin) * problem.time_limit
+        ):
+            source_id, result, _, _, score = memoized
+            db.finish_attempt(db.copy_result, attempt.id, source_id)
+            if is_school:
+                result = "{:.1%}".format(float(score) / 100)
+            print(result, "(the same as attempt %d)" % source_id)
+            logging.info(result, extra=logger_info)
+            return
 
-        db.update_attempt_result_and_stats(
-            attempt.id, "Testing... %d" % test_number, max_time / 1000, max_memory)
-
-        shutil.copyfile(test_file, cnf["files"]["stdin"])
-        protocol = execute_program(cnf, runner_args, data)
-        protocol.cpu_time = int(protocol.cpu_time * cnf["behaviour"]["time_multiplier"] + .5)
-        protocol.real_time = int(protocol.real_time * cnf["behaviour"]["time_multiplier"] + .5)
-        max_time = max(max_time, protocol.cpu_time)
-        max_memory = max(max_memory, protocol.vm_size >> 10)
-        checker_comment = ""
-        if protocol.verdict is Verdict.TL:
-            # ejudge-execute cannot tell TL apart from IL.
-            if protocol.cpu_time < problem.time_limit and protocol.real_time >= problem.time_limit:
-                protocol.verdict = Verdict.IL
-        elif protocol.verdict is Verdict.OK:
-            protocol.verdict, checker_comment = check_output(
-                checker_args,
-                test_file,
-                str(cwd / cnf["files"]["stdout"]),
-                problem.mask_out % test_number if problem.mask_out else os.devnull,
-                cwd=str(tests_path),
-            )
-            checker_comment = checker_comment.decode(errors="replace")
+    # On rejudges, the results of the tests nothing has changed for are taken from test_infos.
+    fingerprints = { }
+    reused = { }
+    if is_school and cnf["behaviour"].get("incremental_rejudge"):
+        fingerprints = fingerprint_tests(
+            cnf, attempt, runner_args, time_multiplier, comparator_spec or checker_args,
+            tests_path, tests,
+        )
+        for test_number, (result, used_time, used_memory, checker_comment, fingerprint) in (
+            db.get_test_infos(attempt.id).items()
+        ):
+            if (
+                fingerprint is not None and fingerprints.get(test_number) == fingerprint and
+                result != Verdict.SE.value
+            ):
+                protocol = CachedProtocol(
+                    Verdict(result), int(used_time * 1000 + .5), used_memory << 10)
+                reused[test_number] = (protocol, checker_comment)
+
+    def reuse(test):
+        print(problem.mask_in % test.number, "(unchanged)", flush=True)
+        return reused[test.number]
+
+    def run_sequentially():
+        for test in tests:
+            if test.number in reused:
+                yield (test.number,) + reuse(test)
+            else:
+                report_progress(test.number)
+                yield (test.number,) + run_test(job, cwd, test)
+
+    def run_failing_first():
+        # Runs the tests most likely to fail first, but skips the ones after a failed test.
+        # Then yields the results in order, so that the lowest-numbered failed test is reported.
+        # The history learns from every test that has been run, reported or not.
+        results = { }
+        first_failed = None
+        used_time, used_memory = 1, 125
+        for test in test_history.order(problem.id, tests):
+            if first_failed is None or test.number < first_failed:
+                report_progress(test.number, used_time, used_memory)
+                results[test.number] = run_test(job, cwd, test)
+                protocol = results[test.number][0]
+                used_time = max(used_time, protocol.cpu_time)
+                used_memory = max(used_memory, protocol.vm_size >> 10)
+                outcomes[test.number] = (protocol.verdict is not Verdict.OK, protocol.cpu_time)
+                if protocol.verdict is not Verdict.OK:
+                    first_failed = test.number
+
+        for test in tests:
+            if test.number not in results:
+                break
+            yield (test.number,) + results[test.number]
+
+    def run_in_parallel(executor):
+        # Results are reported in the order of tests, exactly as if they were run sequentially.
+        futures = [
+            None if test.number in reused else executor.submit(run_isolated_test, job, cwd, test)
+            for test in tests
+        ]
+        try:
+            for test, future in zip(tests, futures):
+                if future is None:
+                    yield (test.number,) + reuse(test)
+                else:
+                    report_progress(test.number)
+                    yield (test.number,) + future.result()
+        finally:
+            for future in futures:
+                if future is not None:
+                    future.cancel()
+
+    print(tests_path, '*', sep=os.sep)
+    with contextlib.ExitStack() as stack:
+        if parallel_tests > 1:
+            executor = stack.enter_context(
+                concurrent.futures.ThreadPoolExecutor(max_workers=parallel_tests))
+            results = run_in_parallel(executor)
+        elif test_history is not None and not is_school:
+            results = run_failing_first()
+        else:
+            results = run_sequentially()
+        stack.callback(results.close)
+
+        for test_number, protocol, checker_comment in results:
+            max_time = max(max_time, protocol.cpu_time)
+            max_memory = max(max_memory, protocol.vm_size >> 10)
+            outcomes[test_number] = (protocol.verdict is not Verdict.OK, protocol.cpu_time)
             print(end=checker_comment)
             if len(checker_comment) > checker_comment_max_len:
                 checker_comment = checker_comment[:checker_comment_max_len - 3] + "..."
 
-        if is_school:
-            db.create_test_info(
-                attempt.id,
-                test_number,
-                protocol.verdict.value,
-                max(protocol.cpu_time, 1) / 1000,
-                max(protocol.vm_size >> 10, 125),
-                checker_comment,
-            )
-            if protocol.verdict is Verdict.OK:
-                passed_tests += 1
-
-        if protocol.verdict is Verdict.SE:
-            print("System error")
-            logging.error("Checker failed on test %d" % test_number, extra=logger_info)
-            db.update_attempt_result_and_stats_with_comment(
-                attempt.id,
-                "System error on test %d" % test_number,
-                max_time / 1000,
-                max_memory,
-                checker_comment,
-            )
-            return
-        elif not is_school and protocol.verdict is not Verdict.OK:
-            result = "%s on test %d" % (protocol.verdict.value, test_number)
-            db.update_attempt_result_and_stats_with_comment(
-                attempt.id,
-                result,
-                max_time / 1000,
-                max_memory,
-                checker_comment,
-            )
-            break
-    else:
-        # All the tests have been run.
-        if is_school:
-            score = passed_tests / test_number
-            db.update_attempt_result_and_stats_with_score(
-                attempt.id,
-                "Tested",
-                max_time / 1000,
-                max_memory,
-                score * 100,
-            )
+            if is_school:
+                db.add_test_info(
+                    attempt.id,
+                    test_number,
+                    protocol.verdict.value,
+                    max(protocol.cpu_time, 1) / 1000,
+                    max(protocol.vm_size >> 10, 125),
+                    checker_comment,
+                    fingerprints.get(test_number),
+                )
+                if protocol.verdict is Verdict.OK:
+                    passed_tests += 1
+
+            if protocol.verdict is Verdict.SE:
+                print("System error")
+                logging.error("Checker failed on test %d" % test_number, extra=logger_info)
+                db.finish_attempt(
+                    db.update_attempt_result_and_stats_with_comment,
+                    attempt.id,
+                    "System error on test %d" % test_number,
+                    max_time / 1000,
+                    max_memory,
+                    checker_comment,
+                )
+                return
+            elif not is_school and protocol.verdict is not Verdict.OK:
+                result = "%s on test %d" % (protocol.verdict.value, test_number)
+                db.finish_attempt(
+                    db.update_attempt_result_and_stats_with_comment,
+                    attempt.id,
+                    result,
+                    max_time / 1000,
+                    max_memory,
+                    checker_comment,
+                )
+                break
         else:
-            result = "Accepted"
-            db.update_attempt_result_and_stats(attempt.id, result, max_time / 1000, max_memory)
+            # All the tests have been run.
+            if is_school:
+                score = passed_tests / test_number
+                db.finish_attempt(
+                    db.update_attempt_result_and_stats_with_score,
+                    attempt.id,
+                    "Tested",
+                    max_time / 1000,
+                    max_memory,
+                    score * 100,
+                )
+            else:
+                result = "Accepted"
+                db.finish_attempt(
+                    db.update_attempt_result_and_stats,
+                    attempt.id, result, max_time / 1000, max_memory,
+                )
+
+    if test_history is not None:
+        test_history.record(problem.id, outcomes)
 
     max_time /= 1000
     max_memory /= 1024
@@ -197,7 +645,27 @@ def run_tests(db, cnf, cwd, attempt, logger_info, data):
     logging.info(result, extra=logger_info)
 
 
-def process_attempt(db, cnf, cwd, attempt, logger_info):
+def compile_attempt(db, cnf, box, attempt, compilation_cache=None) -> (bytes, bytes):
+    labels = {"compiler": attempt.compiler.codename, "problem": attempt.pic.problem.id}
+    box.reset()
+    with metrics.timed("db"):
+        if attempt.source is None:
+            attempt.source = db.get_attempt_source(attempt.id)
+            if attempt.source is None:
+                raise RecoverableError("The attempt has been deleted")
+        db.update_attempt_result(attempt.id, "Compiling...")
+    with metrics.timed("compile", **labels):
+        return compile_source(
+            cnf, attempt.source, attempt.compiler.codename, box.path, compilation_cache)
+
+
+def process_attempt(
+    db, cnf, box, attempt, logger_info, compilation_cache=None, compiled=None, problem_store=None,
+):
+    """
+    `compiled` is a future of `compile_attempt` that has been started in advance, if any.
+    """
+
     start_time = time.perf_counter()
     problem = attempt.pic.problem
     if problem.time_limit % 1000 == 0:
@@ -219,67 +687,268 @@ def process_attempt(db, cnf, cwd, attempt, logger_info):
         time_limit=time_limit,
     ))
 
-    clean_dir(pathlib.Path())
+    labels = {"compiler": attempt.compiler.codename, "problem": problem.id}
+    metrics.attempts.inc(**labels)
 
     print("Compiling...", flush=True)
-    db.update_attempt_result(attempt.id, "Compiling...")
-    data, errors = compile_source(cnf, attempt.source, attempt.compiler.codename)
+    if compiled is None:
+        data, errors = compile_attempt(db, cnf, box, attempt, compilation_cache)
+    else:
+        data, errors = compiled.result()
+        box.reset()
+    cwd = box.path
     if errors:
-        with open(cnf["files"]["compiler_log"], "wb") as f:
+        with open(str(cwd / cnf["files"]["compiler_log"]), "wb") as f:
             f.write(errors)
     if data is None:
         print("Compilation error")
         logging.info("Compilation error", extra=logger_info)
-        db.update_attempt_result_and_error_message(
-            attempt.id, "Compilation error", errors.decode(errors="replace"))
+        db.finish_attempt(
+            db.update_attempt_result_and_error_message,
+            attempt.id, "Compilation error", errors.decode(errors="replace"),
+        )
     else:
-        run_tests(db, cnf, cwd, attempt, logger_info, data)
+        with problem_dir(cnf, problem, problem_store) as tests_path:
+            run_tests(
+                db, cnf, cwd, attempt, logger_info, data, labels, tests_path, compilation_cache)
 
         print("Completed in %.1f seconds." % (time.perf_counter() - start_time))
 
 
-def run(cnf, cwd, name, sleep):
+def available_runners(cnf) -> [str]:
+    return list(cnf["exec"]["runners"]) + [
+        codename for codename in cnf["behaviour"].get("native_runners", { })
+        if codename not in cnf["exec"]["runners"]
+    ]
+
+
+def acquire_attempt(db, cnf, name, queue):
+    """
+    Returns the next attempt to test or None. Claims a batch of attempts if the queue is empty.
+    """
+
+    if not queue:
+        prefetch = cnf["behaviour"].get("prefetch", 1)
+        timeout = cnf["behaviour"].get("heartbeat_timeout")
+        if prefetch > 1 and timeout:
+            # Leave the rest of the queue to the other testers.
+            prefetch = min(prefetch, db.fair_share(
+                cnf["exec"]["compilers"], available_runners(cnf), timeout))
+        if prefetch > 1:
+            queue.extend(db.acquire_untested_attempts(
+                name, "Queued",
+                cnf["exec"]["compilers"],
+                available_runners(cnf),
+                prefetch,
+            ))
+        else:
+            attempt = db.acquire_untested_attempt(
+                name, "Queued",
+                cnf["exec"]["compilers"],
+                available_runners(cnf),
+            )
+            if attempt is not None:
+                queue.append(attempt)
+    return queue.popleft() if queue else None
+
+
+def make_dir(path):
+    path.mkdir(exist_ok=True)
+    path.chmod(0o777)
+    return path
+
+
+def connect(cnf, name) -> (tuple, database.Connection):
+    """
+    Returns the connection kept by the tester with the given name, unless the settings it has
+    been opened with have changed, or opens a new one.
+    """
+
+    params = (
+        cnf["db"]["locator"],
+        cnf["behaviour"].get("progress_interval", 0),
+        tuple(cnf["behaviour"].get("queue_order", ["time"])),
+        cnf["behaviour"].get("max_attempts_per_user", 0),
+    )
+    kept = _connections.pop(name, None)
+    if kept is not None:
+        if kept[0] == params:
+            return kept
+        kept[1].close()
+    return params, database.Connection(*params)
+
+
+def prefetch_problems(db, problem_store):
+    """
+    Prefetches the problems of the contests with untested attempts, once per the store's
+    prefetch interval in the whole process.
+    """
+
+    global _next_prefetch_time
+    with _prefetch_lock:
+        if time.monotonic() < _next_prefetch_time:
+            return
+        _next_prefetch_time = time.monotonic() + problem_store.prefetch_interval
+    problem_store.prefetch(db.get_hot_problem_paths())
+
+
+def close_connections():
+    while _connections:
+        _, (_, db) = _connections.popitem()
+        db.close()
+
+
+def run(cnf, cwd, name, sleep, watcher=None):
+    if cnf["behaviour"].get("native_runners") and not cnf["behaviour"].get("native_cgroup"):
+        raise ValueError("behaviour.native_runners require behaviour.native_cgroup")
     print("Started in", cwd)
     print(flush=True)
-    db = database.Connection(cnf["db"]["locator"])
+    params, db = connect(cnf, name)
+    pipeline = cnf["behaviour"].get("pipeline", False)
+    if pipeline:
+        # The next attempt is compiled in a separate directory while the current one is tested.
+        db = database.BackgroundConnection(db)
+        compiler = concurrent.futures.ThreadPoolExecutor(1)
+        compile_box = sandbox.from_config(cnf, make_dir(cwd / "compile"))
+        box = sandbox.from_config(cnf, make_dir(cwd / "test"))
+    else:
+        box = sandbox.from_config(cnf, cwd)
+    compilation_cache = cache.CompilationCache.from_config(cnf)
+    problem_store = store.ProblemStore.from_config(cnf)
+    queue = collections.deque()
+    pending = None # (attempt, future of its compilation)
+    channel = cnf["behaviour"].get("notify_channel")
+    heartbeat_timeout = cnf["behaviour"].get("heartbeat_timeout")
+    next_reclaim_time = 0
+    # Executables directories are rescanned as soon as they change, even while idle.
+    watched_fds = [ ] if watcher is None or watcher.fileno() is None else [watcher.fileno()]
+    connection_usable = False
     try:
-        status = db.create_tester_status()
+        if cnf["behaviour"].get("install_queue_indexes"):
+            db.install_queue_indexes()
+        if cnf["behaviour"].get("incremental_rejudge"):
+            db.enable_test_fingerprints()
+        if cnf["behaviour"].get("memoize_results"):
+            db.enable_result_memoization()
+        report_multiplier = calibration.enabled(cnf)
+        if report_multiplier:
+            db.enable_time_multiplier_reporting()
+        if channel:
+            db.listen(channel)
+        else:
+            # A kept connection may still be listening on the channel of the previous settings.
+            db.unlisten()
+
+        if heartbeat_timeout:
+            status = db.join_fleet(name, cnf["exec"]["compilers"], available_runners(cnf))
+        else:
+            status = db.create_tester_status()
         try:
             while not needs_restarting:
-                attempt = db.acquire_untested_attempt(
-                    name, "Queued",
-                    cnf["exec"]["compilers"],
-                    cnf["exec"]["runners"],
-                )
-                if attempt is None:
-                    sleep(cnf["behaviour"]["interval"])
-                else:
-                    try:
+                if watcher is not None:
+                    watcher.refresh()
+                if heartbeat_timeout and time.monotonic() >= next_reclaim_time:
+                    next_reclaim_time = time.monotonic() + heartbeat_timeout / 2
+                    reclaimed = db.reclaim_attempts(
+                        heartbeat_timeout, cnf["behaviour"].get("max_retries", 3))
+                    if reclaimed:
+                        print("Reclaimed %d attempts of unresponsive testers" % reclaimed)
+                        print(flush=True)
+                if problem_store is not None:
+                    prefetch_problems(db, problem_store)
+                # A calibration benchmark holds off the testing of further attempts.
+                with calibration.testing():
+                    if pending is not None:
+                        attempt, compiled = pending
+                        pending = None
+                    else:
+                        compiled = None
+                        with metrics.timed("acquire"):
+                            attempt = acquire_attempt(db, cnf, name, queue)
+                    if attempt is not None:
+                        if pipeline:
+                            if compiled is None:
+                                compiled = compiler.submit(
+                                    compile_attempt,
+                                    db, cnf, compile_box, attempt, compilation_cache,
+                                )
+                            # So that the next one does not overwrite the directory.
+                            concurrent.futures.wait((compiled, ))
+                            with metrics.timed("acquire"):
+                                next_attempt = acquire_attempt(db, cnf, name, queue)
+                            if next_attempt is not None:
+                                pending = next_attempt, compiler.submit(
+                                    compile_attempt,
+                                    db, cnf, compile_box, next_attempt, compilation_cache,
+                                )
                         try:
-                            logger_info = {
-                                "pic": attempt.pic,
-                                "problem": attempt.pic.problem,
-                                "contest": attempt.pic.contest,
-                                "compiler": attempt.compiler,
-                                "user": attempt.user,
-                            }
-                            process_attempt(db, cnf, cwd, attempt, logger_info)
+                            try:
+                                logger_info = {
+                                    "pic": attempt.pic,
+                                    "problem": attempt.pic.problem,
+                                    "contest": attempt.pic.contest,
+                                    "compiler": attempt.compiler,
+                                    "user": attempt.user,
+                                }
+                                process_attempt(
+                                    db, cnf, box, attempt, logger_info, compilation_cache, compiled,
+                                    problem_store,
+                                )
+                            except:
+                                print("System error")
+                                db.finish_attempt(
+                                    db.update_attempt_result, attempt.id, "System error")
+                                raise
+                        except RecoverableError as e:
+                            logging.error(e.args[0], extra=logger_info)
+                        except SystemExit:
+                            logging.error("Interrupted", extra=logger_info)
+                            raise
                         except:
-                            print("System error")
-                            db.update_attempt_result(attempt.id, "System error")
+                            logging.exception("System error", extra=logger_info)
                             raise
-                    except RecoverableError as e:
-                        logging.error(e.args[0], extra=logger_info)
-                    except SystemExit:
-                        logging.error("Interrupted", extra=logger_info)
-                        raise
-                    except:
-                        logging.exception("System error", extra=logger_info)
-                        raise
-                    finally:
-                        print(flush=True)
-                db.update_tester_status(status)
+                        finally:
+                            print(flush=True)
+                if attempt is None:
+                    with metrics.timed("idle"):
+                        if not channel:
+                            sleep(cnf["behaviour"]["interval"], *watched_fds)
+                        elif not db.receive_notifications():
+                            # The queue is still polled occasionally in case a notification is lost.
+                            sleep(
+                                cnf["behaviour"].get("fallback_interval", 30),
+                                db.fileno(),
+                                *watched_fds,
+                            )
+                            db.receive_notifications()
+                if report_multiplier:
+                    db.update_tester_status_with_multiplier(
+                        status, cnf["behaviour"]["time_multiplier"])
+                else:
+                    db.update_tester_status(status)
         finally:
-            db.delete_tester_status(status)
+            checkers.servers.close()
+            try:
+                if pending is not None:
+                    attempt, compiled = pending
+                    if compiled.cancel():
+                        queue.appendleft(attempt)
+                    else:
+                        concurrent.futures.wait((compiled, ))
+                        db.release_attempts([attempt.id], name, "Compiling...")
+                if queue:
+                    # Let other testers take the attempts we have not got round to.
+                    db.release_attempts([attempt.id for attempt in queue], name, "Queued")
+            finally:
+                db.delete_tester_status(status)
+        connection_usable = True
     finally:
-        db.close()
+        box.close()
+        if pipeline:
+            compiler.shutdown()
+            compile_box.close()
+        if connection_usable:
+            # Kept for the next run, which is likely to be configured the same way.
+            _connections[name] = (params, db.detach() if pipeline else db)
+        else:
+            db.close()
@@ -0,0 +1,103 @@
+import collections
+import fcntl
+import hashlib
+import itertools
+import os
+import shutil
+import threading
+
+
+Test = collections.namedtuple("Test", ["number", "path", "size", "mtime_ns"])
+
+FICLONE = 0x40049409 # From <linux/fs.h>.
+
+_indices = { }
+_indices_lock = threading.Lock()
+_digests = { } # (path, size, mtime) -> SHA-256
+
+
+def iterpattern(pattern, start=0):
+    """
+    Yields index-annotated file names that match the given pattern.
+    """
+
+    for i in itertools.count(start):
+        file_name = pattern % i
+        if not os.path.isfile(file_name):
+            break
+        yield i, file_name
+
+
+def index(pattern) -> [Test]:
+    """
+    Returns the tests matching the given pattern, starting from 1.
+    The list is cached until the directory containing the tests is modified.
+    """
+
+    stamp = os.stat(os.path.dirname(pattern)).st_mtime_ns
+    with _indices_lock:
+        cached = _indices.get(pattern)
+    if cached is not None and cached[0] == stamp:
+        return cached[1]
+
+    tests = [ ]
+    for number, path in iterpattern(pattern, 1):
+        stat = os.stat(path)
+        tests.append(Test(number, path, stat.st_size, stat.st_mtime_ns))
+    with _indices_lock:
+        _indices[pattern] = (stamp, tests)
+    return tests
+
+
+def digest(path) -> str:
+    """
+    Returns the SHA-256 of the file's contents, which is cached until the file is modified.
+    """
+
+    stat = os.stat(path)
+    key = (path, stat.st_size, stat.st_mtime_ns)
+    with _indices_lock:
+        cached = _digests.get(key)
+    if cached is not None:
+        return cached
+
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(2 ** 20), b""):
+            h.update(chunk)
+    with _indices_lock:
+        _digests[key] = h.hexdigest()
+    return _digests[key]
+
+
+def provide(test, dst, link=False):
+    """
+    Makes the test's input available at `dst` as cheaply as possible: by a reflink if the file
+    system supports it, a hard link if allowed, or by copying otherwise.
+    """
+
+    # `dst` may be a hard link to the previous test, which must not be written through.
+    try:
+        os.unlink(dst)
+    except FileNotFoundError:
+        pass
+
+    dst_fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+    try:
+        with open(test.path, "rb") as src_file:
+            fcntl.ioctl(dst_fd, FICLONE, src_file.fileno())
+        return
+    except OSError:
+        pass
+    finally:
+        os.close(dst_fd)
+
+    if link:
+        try:
+            os.unlink(dst)
+            os.link(test.path, dst)
+            return
+        except OSError:
+            pass # E.g., the tests are on another file system.
+
+    shutil.copyfile(test.path, dst)
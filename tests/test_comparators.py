@@ -0,0 +1,112 @@
+"""
+The expected verdicts and comments are those of testlib's wcmp, lcmp, rcmp6 and rcmp9 on the same
+files.
+
+Run with: python -m unittest discover -s tests
+"""
+
+import os
+import pathlib
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent / "src"))
+
+import comparators
+from verdict import Verdict
+
+
+class ComparatorsTest(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self._dir.cleanup)
+
+    def compare(self, spec, output, answer):
+        output_file = os.path.join(self._dir.name, "output")
+        answer_file = os.path.join(self._dir.name, "answer")
+        with open(output_file, "wb") as f:
+            f.write(output)
+        if answer is not None:
+            with open(answer_file, "wb") as f:
+                f.write(answer)
+        return comparators.get(spec)(output_file, answer_file)
+
+    def test_lines(self):
+        for output, answer, expected in [
+            (b"1\n", b"1\n\n", (Verdict.OK, b"ok single line: '1'\n")),
+            (b"1\n", b"1\n\n\n", (Verdict.OK, b"ok 2 lines\n")),
+            (b"", b"1\n", (Verdict.WA,
+                b"wrong answer 1st lines differ - expected: '1', found: ''\n")),
+            (b"1\r2\n", b"12\n", (Verdict.OK, b"ok single line: '12'\n")),
+            (b"", b"\n", (Verdict.OK, b"ok 0 lines\n")),
+            (b"1  2\n3", b"1 2\r\n3\n", (Verdict.OK, b"ok 2 lines\n")),
+            (b"1\n3\n", b"1\n2\n", (Verdict.WA,
+                b"wrong answer 2nd lines differ - expected: '2', found: '3'\n")),
+            (b"1\n\n  \nx", b"1\n", (Verdict.PE,
+                b"wrong output format Extra information in the output file\n")),
+            (b"x" * 70 + b"\n", b"y\n", (Verdict.WA,
+                b"wrong answer 1st lines differ - expected: 'y', found: '" + b"x" * 30 + b"..."
+                + b"x" * 31 + b"'\n")),
+        ]:
+            self.assertEqual(self.compare("lines", output, answer), expected, (output, answer))
+
+    def test_tokens(self):
+        for output, answer, expected in [
+            (b"1\n2\n", b"1 2", (Verdict.OK, b"ok 2 tokens\n")),
+            (b" 5 ", b"5\n", (Verdict.OK, b'ok "5"\n')),
+            (b"1 3", b"1 2", (Verdict.WA,
+                b"wrong answer 2nd words differ - expected: '2', found: '3'\n")),
+            (b"1", b"1 2", (Verdict.WA,
+                b"wrong answer Unexpected EOF in the participants output\n")),
+            (b"1 2 3", b"1 2", (Verdict.WA,
+                b"wrong answer Participant output contains extra tokens\n")),
+            (b"1\f", b"1", (Verdict.WA,
+                b"wrong answer 1st words differ - expected: '1', found: '1\f'\n")),
+        ]:
+            self.assertEqual(self.compare("tokens", output, answer), expected, (output, answer))
+
+    def test_floats(self):
+        self.assertEqual(
+            self.compare("floats 1e-6", b"1.0000001", b"1.0"),
+            (Verdict.OK, b"ok found '1.0000001', expected '1.0000000', error '0.0000001'\n"),
+        )
+        self.assertEqual(
+            self.compare("floats 1e-6", b"1 2.1", b"1 2"),
+            (Verdict.WA, b"wrong answer 2nd numbers differ - expected: '2.0000000', "
+                b"found: '2.1000000', error = '0.0500000'\n"),
+        )
+        self.assertEqual(
+            self.compare("floats 1e-9", b"1.0000001", b"1"),
+            (Verdict.WA, b"wrong answer 1st numbers differ - expected: '1.0000000000', "
+                b"found: '1.0000001000', error = '0.0000001000'\n"),
+        )
+        self.assertEqual(
+            self.compare("floats 1e-6 3", b"1", b"1"),
+            (Verdict.OK, b"ok found '1.000', expected '1.000', error '0.000'\n"),
+        )
+        for found in (b"1_000", b"nan", b"infinity", b"0x3e8", b"1e5e"):
+            self.assertEqual(
+                self.compare("floats 1e-6", found, b"1000"),
+                (Verdict.PE, b'wrong output format Expected double, but "%s" found\n' % found),
+            )
+        self.assertEqual(self.compare("floats 1e-6", b"1e999 1e", b"1e999 1")[0], Verdict.OK)
+        self.assertEqual(self.compare("floats 1e-6", b"1", b"abc")[0], Verdict.SE)
+        self.assertEqual(self.compare("floats 1e-6", b"1000", b"1_000")[0], Verdict.SE)
+
+    def test_small_chunks(self):
+        self.addCleanup(setattr, comparators, "CHUNK_SIZE", comparators.CHUNK_SIZE)
+        comparators.CHUNK_SIZE = 1
+        self.assertEqual(
+            self.compare("lines", b"1  2\r\n3 \r\r4\n", b"1 2\n3 \r4\n\n"),
+            (Verdict.OK, b"ok 2 lines\n"))
+        self.assertEqual(self.compare("tokens", b"12 34", b"12\n34\n"),
+            (Verdict.OK, b"ok 2 tokens\n"))
+
+    def test_missing_answer(self):
+        for spec in ("exact", "tokens", "lines", "floats 1e-6"):
+            self.assertEqual(self.compare(spec, b"1", None)[0], Verdict.SE, spec)
+
+
+if __name__ == "__main__":
+    unittest.main()
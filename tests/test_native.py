@@ -0,0 +1,80 @@
+"""
+Runs the built-in runner with a stand-in for the cgroup: a plain directory with the files it
+reads, so that no cgroup v2 delegation is needed.
+
+Run with: python -m unittest discover -s tests
+"""
+
+import os
+import pathlib
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent / "src"))
+
+import native
+from verdict import Verdict
+
+
+class _FakeCgroup(native._Cgroup):
+    def __init__(self, root, memory_limit):
+        self.path = os.path.join(root, "run.%d" % next(native._counter))
+        os.mkdir(self.path)
+        self._write("memory.peak", 1 << 20)
+        self._write("memory.events", "oom_kill 0\n")
+
+    def close(self):
+        shutil.rmtree(self.path)
+
+
+class NativeTest(unittest.TestCase):
+    def setUp(self):
+        self._cgroup_class = native._Cgroup
+        native._Cgroup = _FakeCgroup
+        self.addCleanup(setattr, native, "_Cgroup", self._cgroup_class)
+        self.cgroup_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cgroup_root)
+        self.cwd = pathlib.Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, str(self.cwd))
+        (self.cwd / "input").write_bytes(b"1 2\n")
+
+    def run_native(self, command, time_limit=1000):
+        spec = {"file": "a.out", "command": command}
+        return native.run(
+            spec, b"", self.cwd, "input", "output", "error", time_limit, 256, self.cgroup_root)
+
+    def test_ok(self):
+        result = self.run_native(["cat"])
+        self.assertEqual(result.verdict, Verdict.OK)
+        self.assertEqual(result.vm_size, 1 << 20)
+        self.assertEqual((self.cwd / "output").read_bytes(), b"1 2\n")
+
+    def test_high_fds(self):
+        # A tester holds many files open, so its pipes get fds above 9, which dash cannot use.
+        fds = [os.open(os.devnull, os.O_RDONLY) for _ in range(20)]
+        try:
+            result = self.run_native(["cat"])
+        finally:
+            for fd in fds:
+                os.close(fd)
+        self.assertEqual(result.verdict, Verdict.OK)
+        self.assertEqual((self.cwd / "output").read_bytes(), b"1 2\n")
+
+    def test_no_extra_fds(self):
+        self.run_native(["sh", "-c", "ls /proc/$$/fd"])
+        self.assertEqual((self.cwd / "output").read_text().split(), ["0", "1", "2"])
+
+    def test_verdicts(self):
+        self.assertEqual(self.run_native(["sh", "-c", "exit 3"]).verdict, Verdict.RT)
+        self.assertEqual(self.run_native(["sh", "-c", "while :; do :; done"]).verdict, Verdict.TL)
+
+    def test_wrapper_failure(self):
+        (self.cwd / "output").mkdir()
+        with self.assertRaises(OSError):
+            self.run_native(["cat"])
+
+
+if __name__ == "__main__":
+    unittest.main()